@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+# micro benchmarks for the hot paths of wwalker.
+#
+#   python3 bench.py                       - run all benchmarks
+#   python3 bench.py parse intervals       - run selected benchmarks
+#   python3 bench.py --save bench.json     - store results as baseline
+#   python3 bench.py --compare bench.json  - fail on regressions against baseline
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+import tracemalloc
+
+import wwalker
+
+STATUS_LINE = '❤️{hp}/120 🍗{hunger}% 🔋{energy}/10 👣{km}км'
+
+def wasteland(km, hp = 97, hunger = 23, energy = 7):
+    return '''🏜Пустошь
+Вокруг ничего, кроме пыли и ржавых обломков.
+
+{}
+👣 Ты продолжаешь свой путь.'''.format(STATUS_LINE.format(hp = hp, hunger = hunger, energy = energy, km = km))
+
+PIPBOY_FOOD = '''📟Пип-бой 3000 v0.7
+Игрок: Странник
+👤Имя Фамилия
+├🤟 Фракция
+
+❤️Здоровье: 97/120
+🍗Голод: 64%
+🔋Выносливость: 7/10
+
+🗃ПРИПАСЫ В РЮКЗАКЕ
+Пища
+▪️ 🥫Консервы (3) /use_101
+▪️ 🍖Мясо брамина (1) /use_102
+▪️ 🥛Молоко брамина (2) /use_103
+▪️ 🍄Светящийся гриб (4) /use_104
+▪️ 🍗Игуана на палочке (1) /use_105
+▪️ 🥔Картофель (5) /use_106
+▪️ 🍬Сахарные бомбы (2) /use_107
+▪️ 🌽Мутафрукт (1) /use_108
+Вещества
+▪️ 💊Ментаты (1) /use_201
+▪️ 💉Стимулятор (2) /use_202'''
+
+PIPBOY_ENERGY = '''📟Пип-бой 3000 v0.7
+Игрок: Странник
+👤Имя Фамилия
+
+❤️Здоровье: 120/120
+🍗Голод: 12%
+🔋Выносливость: 0/10
+⚔️Урон: 120 🛡Броня: 80'''
+
+GIANT_BATTLEFIELD = '''Ты сейчас на поле боя с гигантом.
+🤖Гигантский робот
+❤️1534/60000
+Вокруг раздаются звуки битвы, десятки выживших атакуют монстра.'''
+
+GIANT = '''Твой путь преградил исполинских размеров монстр.
+Обойти его не получится, придется дать бой.'''
+
+CAMPUS = '''Ты добрался до своего лагеря.'''
+
+CAMPUS_LONG = '''⛺️Лагерь
+Здесь ты можешь отдохнуть от опасностей и сложностей Пустоши.
+Костер еле тлеет, рядом лежит твой спальник.'''
+
+EXHAUSTED = '''Ты слишком устал и не можешь идти дальше.
+Отдохни немного и возвращайся.'''
+
+UNKNOWN = '''Мимо тебя прошел караван торговцев.
+Они не обратили на тебя никакого внимания.
+Пыль медленно оседает на дорогу.'''
+
+CORPUS = [
+    ('wasteland', wasteland(17)),
+    ('wasteland_far', wasteland(74, 45, 55, 2)),
+    ('pipboy_food', PIPBOY_FOOD),
+    ('pipboy_energy', PIPBOY_ENERGY),
+    ('giant_battlefield', GIANT_BATTLEFIELD),
+    ('giant', GIANT),
+    ('campus', CAMPUS),
+    ('campus_long', CAMPUS_LONG),
+    ('exhausted', EXHAUSTED),
+    ('unknown', UNKNOWN)
+]
+
+KEYBOARD_WALK = [
+    ['👣Идти дальше', '⛺️Вернуться'],
+    ['🔎Действие', '📟Пип-бой'],
+    ['🎒Рюкзак', '📦Материалы'],
+    ['🔫Выстрелить', '🤝Поговорить'],
+    ['💬Чат', '📊Рейтинг'],
+    ['⚙️Настройки', '❓Помощь']
+]
+
+KEYBOARD_DUNGEON = [
+    ['Старая шахта', '🦇Бэт-пещера', '🔬Научный комплекс'],
+    ['🚷В Темную зону', '🔜12 км', '🔜22 км', '🔜31 км'],
+    ['⚔️Дать отпор', '🏃Дать деру'],
+    ['👣Идти дaльше', '⛺️Вернуться'],
+    ['📟Пип-бой', '🎒Рюкзак', '❓Помощь']
+]
+
+KEYBOARD_UNKNOWN = [
+    ['🍺Бар', '🏪Магазин', '🏥Госпиталь'],
+    ['🎓Обучение', '🔨Верстак', '📦Склад'],
+    ['💰Обменять все', '📜Квесты'],
+    ['📟Пип-бой', '🎒Рюкзак', '❓Помощь']
+]
+
+FOOD_NAMES = [
+    '🥫Консервы (3) ',
+    '🍖Мясо брамина (1) ',
+    '🥛Молоко брамина (2) ',
+    '🍄Светящийся гриб (4) ',
+    '🍬Сахарные бомбы (2) ',
+    '🌽Мутафрукт (1) '
+]
+
+FOOD_BLACKLIST = ['🍄', '🍬Сахарные', '🥛Молоко', '🦎', '🐀Крысиное', '☢️']
+
+class Benchmark:
+
+    def __init__(self, name, func, n, is_async = False):
+        self.name = name
+        self.func = func
+        self.n = n
+        self.is_async = is_async
+
+    def run_once(self, n):
+        if self.is_async:
+            loop = asyncio.get_event_loop()
+            started = time.perf_counter()
+            loop.run_until_complete(self.func(n))
+            return time.perf_counter() - started
+        started = time.perf_counter()
+        self.func(n)
+        return time.perf_counter() - started
+
+    def run(self, repeat):
+        #warm up caches before measurements
+        self.run_once(max(1, self.n//10))
+
+        best = min([self.run_once(self.n) for i in range(repeat)])
+
+        tracemalloc.start()
+        blocks = sys.getallocatedblocks()
+        self.run_once(self.n)
+        blocks = sys.getallocatedblocks() - blocks
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {
+            'ops_per_sec': self.n/best,
+            'usec_per_op': best*1e6/self.n,
+            'peak_kb': peak/1024,
+            'blocks_per_op': blocks/self.n
+        }
+
+def make_fsm():
+    fsm = wwalker.FSM(None, None)
+    fsm.scheduler.delay_factor = 0
+    fsm.p().food_blacklist = list(FOOD_BLACKLIST)
+    fsm.p().min_hp.from_spec(','.join(['{}/{}'.format(10 + i*10, i*10) for i in range(9)]))
+    fsm.p().dungeons_autoenter[56] = True
+    fsm.p().autojump22 = True
+    return fsm
+
+def bench_parse(n):
+    parser = wwalker.Parser()
+    msgs = [m for name,m in CORPUS]
+    k = len(msgs)
+    def run(n):
+        for i in range(n):
+            parser.parse_and_update(msgs[i%k])
+    return run
+
+def bench_intervals(n):
+    intervals = wwalker.Intervals()
+    intervals.from_spec(','.join(['{}/{}'.format(10 + i*10, i*10) for i in range(9)]))
+    def run(n):
+        for i in range(n):
+            intervals.get(i%100)
+    return run
+
+def bench_food_blacklist(n):
+    profile = make_fsm().p()
+    k = len(FOOD_NAMES)
+    def run(n):
+        for i in range(n):
+            profile.is_food_blacklisted(FOOD_NAMES[i%k])
+    return run
+
+def bench_buttons(n):
+    fsm = make_fsm()
+    fsm.parser.parse_and_update(wasteland(56))
+    events = [wwalker.OfflineEvent(i, '', rows) for i,rows in enumerate([KEYBOARD_WALK, KEYBOARD_DUNGEON, KEYBOARD_UNKNOWN])]
+    k = len(events)
+    def run(n):
+        for i in range(n):
+            fsm.process_buttons(events[i%k])
+    return run
+
+def bench_incoming(n):
+    fsm = make_fsm()
+
+    async def respond(event, text):
+        pass
+
+    keyboards = [KEYBOARD_WALK, KEYBOARD_DUNGEON, KEYBOARD_UNKNOWN]
+    events = [wwalker.OfflineEvent(i, m, keyboards[i%len(keyboards)], respond = respond) for i,(name,m) in enumerate(CORPUS)]
+    k = len(events)
+
+    async def run(n):
+        for i in range(n):
+            event = events[i%k]
+            reply = await fsm.handle_incoming_message(event)
+            if reply:
+                fsm.delayed_reply(event, reply)
+            #let the scheduler drain replies like the real events loop does
+            await asyncio.sleep(0)
+        fsm.on_ctl_reset(None, 'r')
+        await fsm.scheduler.stop()
+    return run
+
+BENCHMARKS = [
+    ('parse', bench_parse, 20000, False),
+    ('intervals', bench_intervals, 200000, False),
+    ('food_blacklist', bench_food_blacklist, 200000, False),
+    ('buttons', bench_buttons, 50000, False),
+    ('incoming', bench_incoming, 10000, True)
+]
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        was = baseline[name]['ops_per_sec']
+        change = (r['ops_per_sec'] - was)/was
+        print('{:<16} {:>12.0f} -> {:>12.0f} ops/sec {:+.1%}'.format(name, was, r['ops_per_sec'], change))
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+def main():
+    arg_parser = argparse.ArgumentParser(description = 'wwalker micro benchmarks')
+    arg_parser.add_argument('names', nargs = '*', help = 'benchmarks to run: ' + ','.join([b[0] for b in BENCHMARKS]))
+    arg_parser.add_argument('--repeat', type = int, default = 5)
+    arg_parser.add_argument('--scale', type = float, default = 1, help = 'iterations multiplier')
+    arg_parser.add_argument('--save', metavar = 'FILE', help = 'save results as JSON baseline')
+    arg_parser.add_argument('--compare', metavar = 'FILE', help = 'compare results with JSON baseline')
+    arg_parser.add_argument('--threshold', type = float, default = 0.1, help = 'ops/sec drop treated as regression (0.1)')
+    args = arg_parser.parse_args()
+
+    wwalker.logger.setLevel(logging.WARNING)
+
+    results = dict()
+    print('{:<16} {:>12} {:>10} {:>10} {:>10}'.format('benchmark', 'ops/sec', 'usec/op', 'peak kb', 'blocks/op'))
+    for name, factory, n, is_async in BENCHMARKS:
+        if args.names and name not in args.names:
+            continue
+        n = max(1, int(n*args.scale))
+        r = Benchmark(name, factory(n), n, is_async).run(args.repeat)
+        results[name] = r
+        print('{:<16} {:>12.0f} {:>10.2f} {:>10.1f} {:>10.3f}'.format(name, r['ops_per_sec'], r['usec_per_op'], r['peak_kb'], r['blocks_per_op']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent = 1, sort_keys = True)
+        print('baseline saved to', args.save)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('regressions:', ','.join(regressions))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,403 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+# load test of the FSM without network.
+# local stand-in for TelegramClient is connected to the scripted world model,
+# which answers every command like WastelandWarsBot does.
+#
+#   python3 loadtest.py --accounts 50 --duration 30
+#   python3 loadtest.py --accounts 5 --rate 200 --delay-factor 0.001
+#   python3 loadtest.py --accounts 5 --rate 50 --replay-check
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+import wwalker
+
+from telethon.tl.types import PeerChat
+
+CTL_CHAT_ID = 1
+
+class World:
+    """
+    scripted game model. command() returns (text,rows) of the next game message
+    """
+
+    DARKZONES = [22, 52, 74]
+
+    KEYBOARD_WALK = [
+        ['👣Идти дальше', '⛺️Вернуться'],
+        ['🔎Действие', '📟Пип-бой'],
+        ['🎒Рюкзак', '📦Материалы', '❓Помощь']
+    ]
+
+    KEYBOARD_FIGHT = [
+        ['⚔️Дать отпор', '🏃Дать деру'],
+        ['📟Пип-бой', '❓Помощь']
+    ]
+
+    KEYBOARD_CAMPUS = [
+        ['👣Пустошь', '💉++ Суперстим', '💊Speed-ы'],
+        ['🍺Бар', '🏪Магазин', '🎓Обучение'],
+        ['📟Пип-бой', '🎒Рюкзак', '❓Помощь']
+    ]
+
+    KEYBOARD_CONFIRM = [
+        ['Вернуться в лагерь', 'Отмена']
+    ]
+
+    FOOD = [
+        ('🥫Консервы', 101, 15),
+        ('🍖Мясо брамина', 102, 25),
+        ('🍄Светящийся гриб', 103, 5),
+        ('🥔Картофель', 104, 10)
+    ]
+
+    def __init__(self, seed = None):
+        self.random = random.Random(seed)
+        self.km = 0
+        self.max_hp = 120
+        self.hp = self.max_hp
+        self.hunger = 0
+        self.max_energy = 10
+        self.energy = self.max_energy
+        self.giant_hp = None
+        self.food = { food_id: 3 for name, food_id, value in self.FOOD }
+
+    def status(self):
+        return '❤️{}/{} 🍗{}% 🔋{}/{} 👣{}км'.format(self.hp, self.max_hp, self.hunger, self.energy, self.max_energy, self.km)
+
+    def location(self, text = 'Вокруг ничего, кроме пыли и ржавых обломков.'):
+        rows = [list(row) for row in self.KEYBOARD_WALK]
+        extra = []
+        if self.km in wwalker.FSM.dungeons:
+            extra.append(wwalker.FSM.dungeons[self.km])
+        if self.km in self.DARKZONES:
+            extra.append('🚷В Темную зону')
+        if extra:
+            rows.insert(0, extra)
+        return ('🏜Пустошь\n{}\n\n{}'.format(text, self.status()), rows)
+
+    def campus(self, text):
+        self.km = 0
+        return (text, self.KEYBOARD_CAMPUS)
+
+    def pipboy(self, food = False):
+        s = '📟Пип-бой 3000 v0.7\n\n❤️Здоровье: {}/{}\n🍗Голод: {}%\n🔋Выносливость: {}/{}\n'.format(
+            self.hp, self.max_hp, self.hunger, self.energy, self.max_energy)
+        if food:
+            s += '\n🗃ПРИПАСЫ В РЮКЗАКЕ\nПища\n'
+            for name, food_id, value in self.FOOD:
+                if self.food[food_id]:
+                    s += '▪️ {} ({}) /use_{}\n'.format(name, self.food[food_id], food_id)
+            s += 'Вещества\n▪️ 💊Ментаты (1) /use_201'
+        return (s, None)
+
+    def walk(self):
+        if self.energy <= 0:
+            return ('Ты слишком устал и не можешь идти дальше.\nОтдохни немного и возвращайся.', None)
+        self.km += 1
+        self.hunger = min(100, self.hunger + 2)
+        if self.random.random() < 0.3:
+            self.energy -= 1
+        r = self.random.random()
+        if r < 0.01:
+            self.giant_hp = self.random.randint(100, 3000)
+            return ('Твой путь преградил исполинских размеров монстр.\nОбойти его не получится.', None)
+        if r < 0.1:
+            return ('На тебя напал 🐀Крысоволк!\n\n' + self.status(), self.KEYBOARD_FIGHT)
+        return self.location()
+
+    def command(self, text):
+        if text in ['👣Идти дальше', '👣Идти дaльше', 'Двигаться дальше', 'Идти вглубь', '🚷В Темную зону', '🔜12 км', '🔜22 км', '🔜31 км']:
+            return self.walk()
+        if text in wwalker.FSM.dungeons.values():
+            return self.walk()
+        if text=='⚔️Дать отпор':
+            self.hp -= self.random.randint(0, 25)
+            if self.hp <= 0:
+                self.hp = self.max_hp
+                return self.campus('Спустя какое-то время ты пришел в себя в своем лагере.')
+            return self.location('Ты победил!')
+        if text=='🏃Дать деру':
+            return self.location('Ты сбежал.')
+        if text=='🔫Выстрелить':
+            return self.location('Ты выстрелил в воздух.')
+        if text=='⛺️Вернуться':
+            return ('Ты уверен, что хочешь вернуться?', self.KEYBOARD_CONFIRM)
+        if text=='Вернуться в лагерь':
+            return self.campus('Ты добрался до своего лагеря.')
+        if text=='👣Пустошь':
+            self.km = 1
+            return self.location()
+        if text=='💉++ Суперстим':
+            self.hp = self.max_hp
+            return ('Использован 💉++ Суперстим.', self.KEYBOARD_CAMPUS)
+        if text=='💊Speed-ы':
+            return ('Использован 💊Психостимулятор.', self.KEYBOARD_CAMPUS)
+        if text=='/me':
+            #every poll is worth some regeneration time
+            self.energy = min(self.max_energy, self.energy + self.random.randint(0, 1))
+            return self.pipboy()
+        if text=='/myfood':
+            return self.pipboy(True)
+        if text.startswith('/use_'):
+            food_id = int(text[5:])
+            for name, fid, value in self.FOOD:
+                if fid==food_id and self.food.get(fid):
+                    self.food[fid] -= 1
+                    self.hunger = max(0, self.hunger - value)
+                    return ('Ты съел {}.\n{}'.format(name, self.status()), None)
+            return ('Нет такого предмета.', None)
+        if text=='/deeprest':
+            self.energy = self.max_energy
+            return self.location('Ты хорошо отдохнул.')
+        if text=='🔎Действие':
+            if self.giant_hp is not None:
+                self.giant_hp -= self.random.randint(0, 1500)
+                return ('Ты сейчас на поле боя с гигантом.\n🤖Гигант\n❤️{}/3000'.format(self.giant_hp), None)
+            return self.location()
+        if text=='⚔️Атаковать':
+            self.giant_hp = None
+            return self.location('Гигант повержен!')
+        return None
+
+class FakeTelegramClient:
+    """
+    in-process stand-in for the part of TelegramClient used by wwalker.
+    game commands are answered by the world model, ctl replies are collected
+    """
+
+    def __init__(self, world, stats, game_latency = 0):
+        self.world = world
+        self.stats = stats
+        self.game_latency = game_latency
+        self.handlers = []
+        self.ctl_messages = []
+        self.connected = False
+        self.disconnected = None
+        self.msg_id = 0
+        self.last_command = time.perf_counter()
+
+    def on(self, builder):
+        def decorator(callback):
+            self.add_event_handler(callback, builder)
+            return callback
+        return decorator
+
+    def add_event_handler(self, callback, builder):
+        self.handlers.append((callback, builder))
+
+    def remove_event_handler(self, callback, builder = None):
+        self.handlers = [h for h in self.handlers if h[0]!=callback]
+
+    async def start(self):
+        await self.connect()
+
+    async def connect(self):
+        self.connected = True
+        self.disconnected = asyncio.Event()
+
+    async def is_user_authorized(self):
+        return True
+
+    def is_connected(self):
+        return self.connected
+
+    async def get_entity(self, peer):
+        return peer
+
+    async def disconnect(self):
+        self.connected = False
+        if self.disconnected:
+            self.disconnected.set()
+
+    async def run_until_disconnected(self):
+        await self.disconnected.wait()
+
+    async def send_message(self, entity, text):
+        if entity==wwalker.GAME_BOT:
+            self.command(text)
+        else:
+            self.ctl_messages.append(text)
+
+    def command(self, text):
+        self.stats.commands += 1
+        self.last_command = time.perf_counter()
+        m = self.world.command(text)
+        if m:
+            if self.game_latency:
+                asyncio.get_event_loop().call_later(self.game_latency, self.push, m[0], m[1])
+            else:
+                asyncio.get_event_loop().call_soon(self.push, m[0], m[1])
+
+    async def respond(self, event, text):
+        if event.created is not None:
+            self.stats.latencies.append(time.perf_counter() - event.created)
+            event.created = None
+        self.command(text)
+
+    def dispatch(self, event, incoming):
+        for callback, builder in self.handlers:
+            if (incoming and builder.incoming) or (not incoming and builder.outgoing):
+                asyncio.ensure_future(callback(event))
+
+    def push(self, text, rows = None):
+        """ deliver game message to the incoming handlers """
+        if not self.connected:
+            return
+        self.msg_id += 1
+        self.stats.events += 1
+        event = wwalker.OfflineEvent(self.msg_id, text, rows, respond = self.respond)
+        event.created = time.perf_counter()
+        self.dispatch(event, True)
+
+    def ctl(self, text):
+        """ deliver ctl chat message to the outgoing handlers """
+        self.msg_id += 1
+
+        async def respond(event, text):
+            self.ctl_messages.append(text)
+
+        self.dispatch(wwalker.OfflineEvent(self.msg_id, text, respond = respond, to_id = PeerChat(CTL_CHAT_ID)), False)
+
+class Stats:
+    def __init__(self):
+        self.events = 0
+        self.commands = 0
+        self.nudges = 0
+        self.latencies = []
+        self.lags = []
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values)*p))]
+
+async def measure_lag(stats, interval = 0.01):
+    """ events loop saturation: how late the loop wakes up comparing to requested """
+    loop = asyncio.get_event_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        stats.lags.append(loop.time() - started - interval)
+
+async def push_load(client, world, rate):
+    """ unsolicited game messages on top of the command/response cycle """
+    tick = 0.01
+    credit = 0
+    while client.connected:
+        await asyncio.sleep(tick)
+        credit += rate*tick
+        while credit >= 1:
+            credit -= 1
+            client.push(*world.location())
+
+async def nudge(client, world, idle):
+    """ stalled account (no commands for idle seconds) gets new location like from the game itself """
+    while client.connected:
+        await asyncio.sleep(idle)
+        if time.perf_counter() - client.last_command >= idle:
+            client.stats.nudges += 1
+            client.push(*world.location())
+
+async def replay_check(accounts):
+    """ replay journals recorded by the run. unchanged code must make the same decisions """
+    changed = 0
+    for a in accounts:
+        a.fsm.journal.close()
+        events, elapsed, diff = await wwalker.replay_journal(a.fsm.journal.filename)
+        changed += len(diff)
+        for msg_id, was, now in diff[:5]:
+            print('  {} {}: {} -> {}'.format(a.name, msg_id, was, now))
+    print('replayed journals: {} changed decisions: {}'.format(len(accounts), changed))
+    return changed
+
+async def run(args, journal_dir = None):
+    stats = Stats()
+
+    accounts = []
+    for i in range(args.accounts):
+        world = World(args.seed + i if args.seed is not None else None)
+        client = FakeTelegramClient(world, stats, args.game_latency)
+        journal = os.path.join(journal_dir, 'load%s.journal' % i) if journal_dir else None
+        account = wwalker.Account('load%s' % i, 0, '', None, CTL_CHAT_ID, None, journal, client)
+        account.fsm.scheduler.delay_factor = args.delay_factor
+        account.world = world
+        accounts.append(account)
+
+    for a in accounts:
+        await a.start(False)
+
+    lag_task = asyncio.ensure_future(measure_lag(stats))
+    tasks = []
+    for a in accounts:
+        a.client.push(*a.world.location())
+        if args.idle:
+            tasks.append(asyncio.ensure_future(nudge(a.client, a.world, args.idle)))
+        if args.rate:
+            tasks.append(asyncio.ensure_future(push_load(a.client, a.world, args.rate)))
+
+    started = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    elapsed = time.perf_counter() - started
+
+    for a in accounts:
+        await a.client.disconnect()
+        await a.fsm.scheduler.stop()
+    lag_task.cancel()
+    for t in tasks:
+        t.cancel()
+    #handlers of already dispatched messages
+    await asyncio.sleep(0)
+
+    print('accounts: {} duration: {:.1f}s'.format(len(accounts), elapsed))
+    print('events: {} ({:.0f}/sec) commands: {} ({:.0f}/sec) nudges: {}'.format(
+        stats.events, stats.events/elapsed, stats.commands, stats.commands/elapsed, stats.nudges))
+    print('reaction latency ms: p50 {:.3f} p90 {:.3f} p99 {:.3f} max {:.3f}'.format(
+        *[percentile(stats.latencies, p)*1000 for p in [0.5, 0.9, 0.99, 1]]))
+    print('loop lag ms: p50 {:.3f} p99 {:.3f} max {:.3f}'.format(
+        *[percentile(stats.lags, p)*1000 for p in [0.5, 0.99, 1]]))
+    errors = sum([a.counters['errors'] for a in accounts])
+    if errors:
+        print('handler errors:', errors)
+    states = dict()
+    for a in accounts:
+        states[a.fsm.state.name] = states.get(a.fsm.state.name, 0) + 1
+    print('fsm states:', ', '.join(['{} {}'.format(k, v) for k, v in sorted(states.items())]))
+    print('max km:', max([a.world.km for a in accounts]))
+
+    if journal_dir:
+        return await replay_check(accounts)
+    return 0
+
+def main():
+    arg_parser = argparse.ArgumentParser(description = 'wwalker load test with local telegram stand-in')
+    arg_parser.add_argument('--accounts', type = int, default = 1)
+    arg_parser.add_argument('--duration', type = float, default = 10, help = 'seconds')
+    arg_parser.add_argument('--rate', type = float, default = 0, help = 'extra unsolicited game messages per second per account')
+    arg_parser.add_argument('--delay-factor', type = float, default = 0, help = 'response delays multiplier (0 - no delays)')
+    arg_parser.add_argument('--idle', type = float, default = 0.1, help = 'push new location to the account stalled for this seconds (0 - never)')
+    arg_parser.add_argument('--game-latency', type = float, default = 0, help = 'game response latency in seconds')
+    arg_parser.add_argument('--seed', type = int)
+    arg_parser.add_argument('--replay-check', action = 'store_true', help = 'journal the run, replay it and fail on changed decisions')
+    args = arg_parser.parse_args()
+
+    wwalker.logger.setLevel(logging.WARNING)
+
+    loop = asyncio.get_event_loop()
+    if args.replay_check:
+        with tempfile.TemporaryDirectory() as journal_dir:
+            return 1 if loop.run_until_complete(run(args, journal_dir)) else 0
+    loop.run_until_complete(run(args))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,53 +9,337 @@ import signal
 import time
 import re
 import platform
-import subprocess
 import copy
+import bisect
+import heapq
+import logging
+import logging.handlers
+import queue
+import argparse
+import json
+import multiprocessing
+import datetime
+import io
+import zlib
+import sqlite3
+import threading
+import importlib.util
+import concurrent.futures
+import cProfile
+import pstats
+import tracemalloc
+import weakref
+import math
 
 from enum import Enum
 from telethon import TelegramClient, sync, events
 from telethon.tl.types import PeerUser, PeerChat, PeerChannel
+from telethon.errors import FloodWaitError
 
 MIN_RESPONSE_DELAY = 5
 MAX_RESPONSE_DELAY = 20
 EXHAUSTED_MODE_DELAY = 120
+#energy regeneration model precision, seconds
+ENERGY_ETA_MARGIN = 5
+#longer waits are not learned from, seconds
+ENERGY_RECOVERY_MAX = 3600
 GIANT_POLL_INTERVAL = (220,380)
+#giant hp model. polls are clamped to these bounds, backoff doubles delay while hp stalls
+GIANT_POLL_MIN = 60
+GIANT_POLL_MAX = 1800
+GIANT_SAMPLES = 6
 INACTIVITY_POLL_TIMEOUT = 180
+#recovery commands sent without any known answer. timeout doubles after each one
+INACTIVITY_RETRIES = 3
+#watchdog timers granularity, seconds
+TIMER_WHEEL_RESOLUTION = 1
 
 DEFAULT_HUNGER_TRHESHOLD = 50
+#hunger restored by the food never eaten before, %
+FOOD_RESTORE_DEFAULT = 10
+#weight of the new observation in the learned restore value
+FOOD_RESTORE_WEIGHT = 0.5
+#delay between commands of one meal, seconds
+MEAL_BURST_DELAY = (1,3)
 
 PROFILES_DIR = 'profiles'
+PROFILES_FLUSH_DELAY = 2
+PROFILES_RETRY_DELAY = 30
+CHECKPOINT_SUFFIX = '.state'
+#state changes within this time are written once, seconds
+CHECKPOINT_FLUSH_DELAY = 5
+CHECKPOINT_MAX_AGE = 6*3600
+
+#latency histograms buckets upper bounds in seconds: 10us .. ~1300s
+METRICS_BUCKETS = [0.00001*2**i for i in range(28)]
+METRICS_FILE_INTERVAL = 15
+
+#outgoing messages limits. [limits] section overrides them
+SEND_RATE = 1
+SEND_BURST = 3
+GLOBAL_SEND_RATE = 20
+GLOBAL_SEND_BURST = 20
+FLOOD_WAIT_RETRIES = 3
+
+#prof/mem ctl commands
+PROFILING_DIR = 'profiling'
+PROFILING_TOP = 15
+PROFILING_MEM_FRAMES = 1
 
 SIGHUP_AVAILABLE = hasattr(signal, 'SIGHUP')
 
-def log(msg):
-    print(time.strftime("%Y-%m-%d %H:%M:%S") + ' ' + msg)
+CONFIG_FILE = 'wwalker.cfg'
+
+#update/restart subprocesses
+MAINTENANCE_TIMEOUT = 120
+OUTPUT_FLUSH_INTERVAL = 2
+MAX_CTL_MESSAGE_LEN = 4000
+#optional file generated at deploy time for non-git installations:
+#  git describe --tags > VERSION; git rev-parse HEAD >> VERSION
+VERSION_FILE = 'VERSION'
+
+#supervisor mode
+RESTART_EXIT_CODE = 3
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_TIMEOUT = 3*HEARTBEAT_INTERVAL
+ROLLUP_INTERVAL = 300
+RESTART_BACKOFF = (1,300)
+
+LOG_FORMAT = '%(asctime)s %(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+LOG_DEFAULT_LEVEL = 'info'
+LOG_MAX_BYTES = 10*1024*1024
+LOG_BACKUP_COUNT = 5
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR
+}
+
+logger = logging.getLogger('wwalker')
+log_listener = None
+
+def log(msg, *args):
+    logger.info(msg, *args)
+
+def log_debug(msg, *args):
+    logger.debug(msg, *args)
+
+def log_error(msg, *args):
+    logger.error(msg, *args)
+
+#single thread keeps the order of background writes to the same file
+disk_writer = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+
+def atomic_write(filename, data):
+    """ readers never see partially written file """
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+def wait_disk_writes():
+    """ block until the background writes queued so far are done """
+    disk_writer.submit(lambda: None).result()
+
+def setup_logging(cfg, suffix = None):
+    """
+    records are passed through the queue to the background thread,
+    so slow stdout or disk never stall the events loop
+    """
+    global log_listener
+
+    section = cfg['log'] if 'log' in cfg else {}
+
+    level = section.get('level', LOG_DEFAULT_LEVEL)
+    if level not in LOG_LEVELS:
+        raise Exception('unexpected log level "%s" in section [log]' % level)
+
+    formatter = logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT)
+
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if 'file' in section:
+        #every supervised worker writes its own file
+        filename = section['file'] if suffix is None else '%s.%s' % (section['file'],suffix)
+        handlers.append(logging.handlers.RotatingFileHandler(
+            filename,
+            maxBytes = int(section.get('max_bytes', LOG_MAX_BYTES)),
+            backupCount = int(section.get('backup_count', LOG_BACKUP_COUNT)),
+            encoding = 'utf-8'))
+    for h in handlers:
+        h.setFormatter(formatter)
+
+    q = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(q))
+    logger.setLevel(LOG_LEVELS[level])
+    logger.propagate = False
+
+    log_listener = logging.handlers.QueueListener(q, *handlers)
+    log_listener.start()
+
+def shutdown_logging():
+    global log_listener
+    if log_listener:
+        log_listener.stop()
+        log_listener = None
+
+def read_ref(git_dir, ref):
+    try:
+        with open(os.path.join(git_dir, ref)) as f:
+            return f.read().strip()
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(git_dir, 'packed-refs')) as f:
+            for line in f:
+                v = line.split()
+                if len(v)==2 and v[1]==ref:
+                    return v[0]
+    except OSError:
+        pass
+    return None
+
+def peel_tag(git_dir, sha):
+    """ commit of the loose annotated tag object """
+    try:
+        with open(os.path.join(git_dir, 'objects', sha[:2], sha[2:]), 'rb') as f:
+            data = zlib.decompress(f.read())
+    except (OSError, zlib.error):
+        return None
+    header, _, body = data.partition(b'\0')
+    if not header.startswith(b'tag ') or not body.startswith(b'object '):
+        return None
+    return body[len(b'object '):].split(b'\n',1)[0].decode()
+
+def tags_for(git_dir, commit):
+    """ tags pointing exactly to the commit. annotated tags are matched by their peeled value """
+    tags = []
+    tags_dir = os.path.join(git_dir, 'refs', 'tags')
+    if os.path.isdir(tags_dir):
+        for name in os.listdir(tags_dir):
+            sha = read_ref(git_dir, 'refs/tags/' + name)
+            if sha==commit or (sha and peel_tag(git_dir, sha)==commit):
+                tags.append(name)
+    try:
+        with open(os.path.join(git_dir, 'packed-refs')) as f:
+            tag = None
+            for line in f:
+                v = line.split()
+                if line.startswith('^'):
+                    if tag and v[0][1:]==commit:
+                        tags.append(tag)
+                    continue
+                tag = None
+                if len(v)==2 and v[1].startswith('refs/tags/'):
+                    tag = v[1][len('refs/tags/'):]
+                    if v[0]==commit:
+                        tags.append(tag)
+    except OSError:
+        pass
+    return sorted(set(tags))
+
+def read_version(base_dir = None):
+    """
+    version of the code on disk without spawning git.
+    reads VERSION file or .git internals. returns (tags,commit)
+    """
+    if base_dir is None:
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+
+    try:
+        with open(os.path.join(base_dir, VERSION_FILE)) as f:
+            lines = f.read().split()
+            if len(lines)>=2:
+                return (lines[0],lines[1])
+            if lines:
+                return ('',lines[0])
+    except OSError:
+        pass
+
+    git_dir = os.path.join(base_dir, '.git')
+    if os.path.isfile(git_dir):
+        #worktrees and submodules have 'gitdir: path' file instead of directory
+        with open(git_dir) as f:
+            content = f.read().strip()
+        if content.startswith('gitdir:'):
+            git_dir = os.path.join(base_dir, content[len('gitdir:'):].strip())
+
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+    except OSError:
+        return ('','unknown')
+
+    branch = ''
+    commit = head
+    if head.startswith('ref:'):
+        ref = head[len('ref:'):].strip()
+        branch = ref.split('/')[-1]
+        commit = read_ref(git_dir, ref)
+        if commit is None:
+            #worktree HEAD refers to the branch of the main repository
+            common = os.path.join(git_dir, 'commondir')
+            if os.path.isfile(common):
+                with open(common) as f:
+                    commit = read_ref(os.path.join(git_dir, f.read().strip()), ref)
+        if commit is None:
+            return (branch,'unknown')
+
+    tags = tags_for(git_dir, commit)
+    return (','.join(tags) if tags else branch, commit)
+
+def format_version(version):
+    return '  tags: {}\n  commit: {}\n'.format(*version)
+
+runtime_version_cache = None
+
+def runtime_version():
+    """ version of the running code. read once on the first request """
+    global runtime_version_cache
+    if runtime_version_cache is None:
+        runtime_version_cache = format_version(read_version())
+    return runtime_version_cache
 
 
 class Intervals:
 
     def __init__(self):
         self.points = { 0: 0 }
+        self.invalidate()
+
+    def invalidate(self):
+        #sorted breakpoints cache. rebuilt lazily on the first lookup after any write
+        self.sorted_keys = None
+        self.sorted_values = None
+
+    def breakpoints(self):
+        if self.sorted_keys is None:
+            self.sorted_keys = sorted(self.points.keys())
+            self.sorted_values = [self.points[k] for k in self.sorted_keys]
+        return self.sorted_keys
 
     def add(self,start,value):
         if start is None:
             return
-        if not self.points:
-            self.points[start] = value
-            return
+        #drop all breakpoints beyond the new one
+        keys = self.breakpoints()
+        for k in keys[bisect.bisect_right(keys,start):]:
+            del self.points[k]
         self.points[start] = value
-        for k in sorted(self.points.keys(),reverse = True):
-            if k > start:
-                del self.points[k]
+        self.invalidate()
 
     def clear(self):
         self.points = {}
+        self.invalidate()
 
     def get(self,pos):
-        for k in sorted(self.points.keys(), reverse = True):
-            if pos >= k:
-                return self.points[k]
-
+        keys = self.breakpoints()
+        i = bisect.bisect_right(keys,pos)
+        if i:
+            return self.sorted_values[i-1]
         return 0
 
     def from_spec(self, spec):
@@ -102,16 +386,16 @@ class Intervals:
         if not self.points:
             return ''
         specs = []
-        for k in sorted(self.points.keys()):
-            specs.append('/'.join([str(self.points[k]),str(k)]))
+        for k,v in zip(self.breakpoints(),self.sorted_values):
+            specs.append('/'.join([str(v),str(k)]))
         return ','.join(specs)
 
     def to_spec_bool(self):
         if not self.points:
             return ''
         specs = []
-        for k in sorted(self.points.keys()):
-            specs.append('/'.join([self.bool2str(self.points[k]),str(k)]))
+        for k,v in zip(self.breakpoints(),self.sorted_values):
+            specs.append('/'.join([self.bool2str(v),str(k)]))
         return ','.join(specs)
 
     def __str__(self):
@@ -133,15 +417,34 @@ class Parser:
         FailedToCraft = 10
         DeepRest = 11
 
-    def __init__(self):
+    #message markers in order of priority. the first one matched by the priority wins
+    markers = [
+        (MatchedMessage.PipBoy, r'\A' + re.escape('📟Пип-бой 3000')),
+        (MatchedMessage.FailedToCraft, r'\A' + re.escape('Недостаточно ресурсов для изготовления предмета.') + r'\Z'),
+        (MatchedMessage.CampusReached, '|'.join([
+            r'\A' + re.escape('Ты добрался до своего лагеря.') + r'\Z',
+            re.escape('Спустя какое-то время ты пришел в себя в своем лагере.'),
+            re.escape('Здесь ты можешь отдохнуть от опасностей и сложностей Пустоши.')])),
+        (MatchedMessage.Exhausted, r'\A' + re.escape('Ты слишком устал и не можешь ') + '(?:' + re.escape('идти дальше.') + '|' + re.escape('отправиться в Пустошь.') + ')'),
+        (MatchedMessage.SupersteamUsed, re.escape('Использован 💉++ Суперстим.')),
+        (MatchedMessage.SpeedsUsed, re.escape('Использован 💊Психостимулятор.')),
+        (MatchedMessage.Giant, re.escape('Твой путь преградил исполинских размеров монстр.')),
+        (MatchedMessage.DeepRest, re.escape('Устроить привал /deeprest')),
+        (MatchedMessage.GiantBattlefield, r'\A(?:' + re.escape('Ты сейчас на поле боя с гигантом.') + '|' + re.escape('Твое местоположение: Возле гиганта') + ')'),
+        (MatchedMessage.RinoReached, r'\A' + re.escape('Некогда здесь был довольно большой, но в то же время уютный город Рино, а местные жители гордо называли его "Самый большой маленький городок в мире".')),
+        (MatchedMessage.WastelandLocation, r'^(?:🚷 ?)?❤️(?P<hp>-?\d+)/(?P<max_hp>\d+) 🍗(?P<hunger>\d+)% 🔋(?P<energy>\d+)/(?P<max_energy>\d+) 👣(?P<km>\d+)км$')
+    ]
 
-        self.status_line_regexp = re.compile('^(?:🚷 ?)?❤️(-?\d+)/(\d+) 🍗(\d+)% 🔋(\d+)/(\d+) 👣(\d+)км$',re.MULTILINE)
-        self.food_regexp = re.compile('^🗃ПРИПАСЫ В РЮКЗАКЕ$',re.MULTILINE)
-        self.food_line_regexp = re.compile('^▪️ +(.*?)/use_(\d+)$',re.MULTILINE)
-        self.giant_hp_regexp = re.compile('^❤️(-?\d+)/(\d+)$',re.MULTILINE)
+    classifier_regexp = re.compile('|'.join(['(?P<m%d>%s)' % (i,r) for i,(t,r) in enumerate(markers)]),re.MULTILINE)
 
-        #PipBoy lines
-        self.pipboy_energy = re.compile('^🔋Выносливость: (\d+)/(\d+)$',re.MULTILINE)
+    food_regexp = re.compile('^🗃ПРИПАСЫ В РЮКЗАКЕ$',re.MULTILINE)
+    food_line_regexp = re.compile('^▪️ +(.*?)(?: \((\d+)\))? */use_(\d+)$',re.MULTILINE)
+    giant_hp_regexp = re.compile('^❤️(-?\d+)/(\d+)$',re.MULTILINE)
+
+    #PipBoy lines
+    pipboy_energy = re.compile('^🔋Выносливость: (\d+)/(\d+)$',re.MULTILINE)
+
+    def __init__(self):
 
         self.matched_message = None
 
@@ -152,21 +455,48 @@ class Parser:
         self.energy = None
         self.max_energy = None
         self.km = None
+        self.giant_hp = None
+        self.giant_max_hp = None
 
         #inventory related stuff
         self.food = []
 
+    def on_reloaded(self):
+        """ called after the class of the live parser was replaced by the reloaded one """
+        if self.matched_message is not None:
+            self.matched_message = self.MatchedMessage[self.matched_message.name]
+
+    def classify(self, msg):
+        """
+        scan message once against all the known markers.
+        returns (MatchedMessage,match) for the highest priority marker or (None,None)
+        """
+        best = None
+        best_match = None
+        for m in self.classifier_regexp.finditer(msg):
+            idx = int(m.lastgroup[1:])
+            if best is None or idx < best:
+                best = idx
+                best_match = m
+                if not best:
+                    break
+        if best is None:
+            return (None,None)
+        return (self.markers[best][0],best_match)
+
     def parse_and_update(self, msg):
 
         self.matched_message = None
-    
-        print(msg)
 
-        if msg.startswith('📟Пип-бой 3000'):
+        log_debug(msg)
+
+        (matched, m) = self.classify(msg)
+
+        if matched==self.MatchedMessage.PipBoy:
             #try to parse pip boy
             m = self.pipboy_energy.search(msg)
             if m:
-                (self.energy, self.max_energy) = m.groups()
+                (self.energy, self.max_energy) = map(int,m.groups())
                 self.matched_message = self.MatchedMessage.PipBoy
 
             m = self.food_regexp.search(msg)
@@ -184,38 +514,22 @@ class Parser:
                             break
                         m = self.food_line_regexp.match(s)
                         if not m:
-                            print("failed to parse food line: %s" % s)
+                            log("failed to parse food line: %s" % s)
                             continue
-                        (food_name, food_id) = m.groups()
-                        self.food.append({ 'name': food_name, 'id': food_id })
+                        (food_name, food_count, food_id) = m.groups()
+                        self.food.append({ 'name': food_name, 'id': food_id, 'count': int(food_count) if food_count else 1 })
                 if self.food:
                     self.matched_message = self.MatchedMessage.Food
-        elif msg=='Недостаточно ресурсов для изготовления предмета.':
-            self.matched_message = self.MatchedMessage.FailedToCraft
-        elif msg=='Ты добрался до своего лагеря.' or -1!=msg.find('Спустя какое-то время ты пришел в себя в своем лагере.') or -1!=msg.find('Здесь ты можешь отдохнуть от опасностей и сложностей Пустоши.'):
-            self.matched_message = self.MatchedMessage.CampusReached
-        elif msg.startswith('Ты слишком устал и не можешь идти дальше.') or msg.startswith('Ты слишком устал и не можешь отправиться в Пустошь.'):
-            self.matched_message = self.MatchedMessage.Exhausted
-        elif -1!=msg.find('Использован 💉++ Суперстим.'):
-            self.matched_message = self.MatchedMessage.SupersteamUsed
-        elif -1!=msg.find('Использован 💊Психостимулятор.'):
-            self.matched_message = self.MatchedMessage.SpeedsUsed
-        elif -1!=msg.find('Твой путь преградил исполинских размеров монстр.'):
-            self.matched_message = self.MatchedMessage.Giant
-        elif -1!=msg.find('Устроить привал /deeprest'):
-            self.matched_message = self.MatchedMessage.DeepRest
-        elif msg.startswith('Ты сейчас на поле боя с гигантом.') or msg.startswith('Твое местоположение: Возле гиганта'):
+        elif matched==self.MatchedMessage.GiantBattlefield:
             m = self.giant_hp_regexp.search(msg)
             if m:
                 self.matched_message = self.MatchedMessage.GiantBattlefield
-                (self.giant_hp, self.giant_max_hp) = m.groups()
-        elif msg.startswith('Некогда здесь был довольно большой, но в то же время уютный город Рино, а местные жители гордо называли его "Самый большой маленький городок в мире".'):
-            self.matched_message = self.MatchedMessage.RinoReached
+                (self.giant_hp, self.giant_max_hp) = map(int,m.groups())
+        elif matched==self.MatchedMessage.WastelandLocation:
+            (self.hp, self.max_hp, self.hunger, self.energy, self.max_energy, self.km) = map(int,m.group('hp','max_hp','hunger','energy','max_energy','km'))
+            self.matched_message = self.MatchedMessage.WastelandLocation
         else:
-            m = self.status_line_regexp.search(msg)
-            if m:
-                (self.hp, self.max_hp, self.hunger, self.energy, self.max_energy, self.km) = m.groups()
-                self.matched_message = self.MatchedMessage.WastelandLocation
+            self.matched_message = matched
 
     def __str__(self):
         def w(v):
@@ -238,7 +552,13 @@ class Profile():
 
     DUNGEONS_TO_SKIP_ON_SET_ALL = [19]
 
+    #reply delay categories. see FSM.reply_category()
+    DELAY_CATEGORIES = ['walk','fight','home','enter','food','campus','default']
+
     def __init__(self):
+        #changed since the last save
+        self.dirty = False
+
         self.dungeons_autoenter = dict()
 
         self.darkzone_autoenter = {
@@ -248,14 +568,21 @@ class Profile():
         }
 
     def load_from_file(self, fsm, filename):
+        data = None
+        if filename is not None:
+            with open(filename) as f:
+                data = f.read()
+        self.load(fsm, data)
+
+    def load(self, fsm, data):
 
         parser = configparser.ConfigParser()
         cfg = None
 
-        if filename is None:
+        if data is None:
             parser['profile'] = {}
         else:
-            parser.read(filename)
+            parser.read_string(data)
 
         cfg = parser['profile']
 
@@ -285,6 +612,18 @@ class Profile():
         self.threshold_action = self.ThresholdAction[cfg.get('threshold_action')] if 'threshold_action' in cfg else self.ThresholdAction.gohome
         self.food_blacklist = cfg.get('food_blacklist').split(',') if 'food_blacklist' in cfg else []
 
+        self.delays = dict()
+        if 'delay' in cfg:
+            ret = self.set_delays(cfg.get('delay'))
+            if ret:
+                raise Exception('failed to parse delay spec: ' + ret)
+        self.delay_km = self.new_delay_km()
+        if 'delay_km' in cfg:
+            ret = self.delay_km.from_spec(cfg.get('delay_km'))
+            if ret:
+                raise Exception('failed to parse delay_km spec: ' + ret)
+        self.daily_budget = cfg.getint('daily_budget') if 'daily_budget' in cfg else 0
+
         #ensure only one autojump is enabled
         if self.autojump12:
             self.autojump22 = False
@@ -323,9 +662,55 @@ class Profile():
                     if km in self.darkzone_autoenter:
                         self.darkzone_autoenter[km] = True
 
+    def touch(self):
+        self.dirty = True
+
+    def new_delay_km(self):
+        #percents of the reply delay, 100% everywhere by default
+        delay_km = Intervals()
+        delay_km.add(0,100)
+        return delay_km
+
+    def set_delays(self, spec):
+        """ CATEGORY:MIN-MAX[,CATEGORY:MIN-MAX...] in seconds """
+        try:
+            delays = dict()
+            for item in spec.split(','):
+                category, interval = item.split(':')
+                if category not in self.DELAY_CATEGORIES:
+                    return 'unknown category: ' + category
+                lo, hi = [float(v) for v in interval.split('-')]
+                if lo < 0 or hi < lo:
+                    return 'wrong interval: ' + interval
+                delays[category] = (lo,hi)
+        except ValueError:
+            return 'failed to parse input'
+        self.delays.update(delays)
+        return None
+
+    def get_delays_spec(self):
+        return ','.join(['{}:{:g}-{:g}'.format(c,*self.delays[c]) for c in self.DELAY_CATEGORIES if c in self.delays])
+
+    def get_delay(self, category):
+        return self.delays.get(category, self.delays.get('default', (MIN_RESPONSE_DELAY,MAX_RESPONSE_DELAY)))
+
+    def on_reloaded(self):
+        """ called after the class of the live profile was replaced by the reloaded one """
+        self.threshold_action = self.ThresholdAction[self.threshold_action.name]
+        self.min_hp.__class__ = Intervals
+        self.cowardice.__class__ = Intervals
+        for k,v in [('delays',dict()), ('delay_km',self.new_delay_km()), ('daily_budget',0)]:
+            self.__dict__.setdefault(k,v)
+        if 'food_blacklist' in self.__dict__:
+            self.food_blacklist = self.__dict__.pop('food_blacklist')
+        self.delay_km.__class__ = Intervals
+
     def save_to_file(self, filename):
-        print('save to file:',filename)
+        log('save to file: %s' % filename)
+        atomic_write(filename, self.dump())
+        self.dirty = False
 
+    def dump(self):
         parser = configparser.ConfigParser()
         parser['profile'] = {}
         cfg = parser['profile']
@@ -353,6 +738,14 @@ class Profile():
         if self.food_blacklist:
             cfg['food_blacklist'] = ','.join(self.food_blacklist)
 
+        if self.delays:
+            cfg['delay'] = self.get_delays_spec()
+        delay_km_spec = self.delay_km.to_spec()
+        if delay_km_spec!='100/0':
+            cfg['delay_km'] = delay_km_spec
+        if self.daily_budget:
+            cfg['daily_budget'] = str(self.daily_budget)
+
         l = [str(km) for km,v in self.dungeons_autoenter.items() if v]
         if l:
             cfg['autodunge'] = ','.join(l)
@@ -361,8 +754,9 @@ class Profile():
         if l:
             cfg['autodarkzone'] = ','.join(l)
 
-        with open(filename, 'w') as f:
-            parser.write(f)
+        f = io.StringIO()
+        parser.write(f)
+        return f.getvalue()
 
     def get_food_blacklist(self):
         if not self.food_blacklist:
@@ -372,11 +766,21 @@ class Profile():
             s += '{}: {}\n'.format(idx,prefix)
         return s
 
+    @property
+    def food_blacklist(self):
+        return self._food_blacklist
+
+    @food_blacklist.setter
+    def food_blacklist(self, prefixes):
+        """ prefixes are kept as a tuple, so every edit goes through here and rebuilds the matcher """
+        self._food_blacklist = tuple(prefixes)
+        if self._food_blacklist:
+            self.food_blacklist_regexp = re.compile('|'.join([re.escape(p) for p in self._food_blacklist]))
+        else:
+            self.food_blacklist_regexp = None
+
     def is_food_blacklisted(self, food_name):
-        for prefix in self.food_blacklist:
-            if food_name.startswith(prefix):
-                return True
-        return False
+        return self.food_blacklist_regexp is not None and self.food_blacklist_regexp.match(food_name) is not None
 
     def __str__(self):
         return '''
@@ -390,6 +794,9 @@ autoloop: %s
 autoshoot: %s
 autospeeds: %s
 autojump12,22,31: %s %s %s
+delays: %s
+delay km: %s
+daily budget: %s
 ''' % (self.description,
        self.max_km_tresh, str(self.min_hp),
        self.min_hunger_tresh,
@@ -398,7 +805,836 @@ autojump12,22,31: %s %s %s
        self.autoloop,
        self.autoshoot,
        self.autospeeds,
-       self.autojump12, self.autojump22, self.autojump31)
+       self.autojump12, self.autojump22, self.autojump31,
+       self.get_delays_spec() or 'default',
+       self.delay_km.to_spec(),
+       self.daily_budget if self.daily_budget else 'unlimited')
+
+class ProfileStore:
+    """
+    profiles of all the accounts in the single sqlite database.
+    rows keep the same INI text as profile files
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        #writes come from the executor threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, timeout = 30, check_same_thread = False)
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS profiles (
+                account TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (account, idx)) WITHOUT ROWID''')
+
+    def query(self, sql, *args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def first(self, account):
+        """ lowest profile index or None if account has no profiles """
+        return self.query('SELECT MIN(idx) FROM profiles WHERE account=?', account)[0][0]
+
+    def indexes(self, account):
+        return [r[0] for r in self.query('SELECT idx FROM profiles WHERE account=? ORDER BY idx', account)]
+
+    def get(self, account, idx):
+        rows = self.query('SELECT data FROM profiles WHERE account=? AND idx=?', account, idx)
+        return rows[0][0] if rows else None
+
+    def put(self, account, items):
+        """ items: list of (idx,data) """
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO profiles (account,idx,data) VALUES (?,?,?)',
+                [(account,idx,data) for idx,data in items])
+
+    def delete(self, account, idx):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM profiles WHERE account=? AND idx=?', (account,idx))
+
+    def migrate(self, account, profiles_dir):
+        """ one-shot import of profile files. returns number of imported profiles """
+        if not os.path.isdir(profiles_dir):
+            return 0
+        items = []
+        for f in os.listdir(profiles_dir):
+            path = profiles_dir + '/' + f
+            if not f.isdigit() or not os.path.isfile(path):
+                continue
+            with open(path) as fd:
+                items.append((int(f), fd.read()))
+        self.put(account, items)
+        return len(items)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def open_profiles_store(cfg):
+    """ [profiles] db = FILE switches all the accounts to the sqlite store """
+    if 'profiles' not in cfg or 'db' not in cfg['profiles']:
+        return None
+    return ProfileStore(cfg['profiles']['db'])
+
+class Histogram:
+    """ fixed buckets histogram. quantiles are interpolated inside the bucket """
+
+    def __init__(self, buckets = METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.count += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q):
+        if not self.count:
+            return 0
+        rank = q*self.count
+        seen = 0
+        for i,n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lo = self.buckets[i-1] if i else 0
+                hi = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(self.max, lo + (hi - lo)*(rank - seen)/n)
+            seen += n
+        return self.max
+
+class Metrics:
+    """
+    per account stage latencies and counters.
+    stages: parse, handle_state, process_buttons - processing of incoming message,
+    delay - real delay of scheduled reply, respond - send call,
+    reaction - from incoming message to sent reply, throttle - wait for the rate limiters
+    """
+
+    STAGES = ['parse','handle_state','process_buttons','delay','throttle','respond','reaction']
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = { s: Histogram() for s in self.STAGES }
+        self.messages = dict()
+        self.transitions = dict()
+        self.buttons = dict()
+        self.km = 0
+        self.last_km = None
+        #reply delay category -> [count,sum]
+        self.delays = dict()
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+        #id and time of the last incoming message to measure reaction
+        self.last_event = (None,0)
+
+    def observe(self, stage, v):
+        self.stages[stage].observe(v)
+
+    def inc(self, counters, key):
+        counters[key] = counters.get(key,0) + 1
+
+    def on_delay(self, category, delay):
+        d = self.delays.setdefault(category, [0,0])
+        d[0] += 1
+        d[1] += delay
+
+    def on_km(self, km):
+        """ distance walked. km counter drops when journey starts over """
+        if self.last_km is not None and km > self.last_km:
+            self.km += km - self.last_km
+        self.last_km = km
+
+    def km_per_hour(self):
+        return self.km*3600/max(1, time.time() - self.started)
+
+    def __str__(self):
+        uptime = int(time.time() - self.started)
+        s = 'uptime: {}h{:02}m\n'.format(uptime//3600, uptime%3600//60)
+        s += 'km walked: {} ({:.1f} km/hour)\n'.format(self.km, self.km_per_hour())
+        if self.flood_waits:
+            s += 'flood waits: {} ({}s)\n'.format(self.flood_waits, self.flood_wait_seconds)
+        s += '\nlatency ms (count p50 p99 max):\n'
+        for name,h in self.stages.items():
+            if h.count:
+                s += '{}: {} {:.2f} {:.2f} {:.2f}\n'.format(name, h.count, h.quantile(0.5)*1000, h.quantile(0.99)*1000, h.max*1000)
+        if self.delays:
+            s += '\nreply delays (count avg):\n'
+            for k,(n,total) in sorted(self.delays.items()):
+                s += '{}: {} {:.1f}s\n'.format(k, n, total/n)
+        for title,counters in [('messages',self.messages), ('transitions',self.transitions), ('buttons',self.buttons)]:
+            if counters:
+                s += '\n{}:\n'.format(title)
+                for k,v in sorted(counters.items(), key = lambda i: -i[1]):
+                    s += '{}: {}\n'.format(k,v)
+        return s
+
+    def prometheus(self, account):
+        """ metrics in prometheus text format, without TYPE headers """
+        def labels(**kw):
+            return ','.join(['{}="{}"'.format(k, str(v).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')) for k,v in kw.items()])
+
+        lines = []
+        for name,h in self.stages.items():
+            seen = 0
+            for le,n in zip(self.buckets_labels(h), h.counts):
+                seen += n
+                lines.append('wwalker_stage_seconds_bucket{%s} %d' % (labels(account = account, stage = name, le = le), seen))
+            lines.append('wwalker_stage_seconds_sum{%s} %f' % (labels(account = account, stage = name), h.sum))
+            lines.append('wwalker_stage_seconds_count{%s} %d' % (labels(account = account, stage = name), h.count))
+        for k,v in self.messages.items():
+            lines.append('wwalker_messages_total{%s} %d' % (labels(account = account, type = k), v))
+        for (a,b),v in self.transitions_items():
+            lines.append('wwalker_transitions_total{%s} %d' % (labels(account = account, src = a, dst = b), v))
+        for k,v in self.buttons.items():
+            lines.append('wwalker_buttons_total{%s} %d' % (labels(account = account, button = k), v))
+        for k,(n,total) in self.delays.items():
+            lines.append('wwalker_reply_delay_seconds_sum{%s} %f' % (labels(account = account, category = k), total))
+            lines.append('wwalker_reply_delay_seconds_count{%s} %d' % (labels(account = account, category = k), n))
+        lines.append('wwalker_km_total{%s} %d' % (labels(account = account), self.km))
+        lines.append('wwalker_flood_waits_total{%s} %d' % (labels(account = account), self.flood_waits))
+        lines.append('wwalker_flood_wait_seconds_total{%s} %d' % (labels(account = account), self.flood_wait_seconds))
+        lines.append('wwalker_uptime_seconds{%s} %d' % (labels(account = account), time.time() - self.started))
+        return lines
+
+    def buckets_labels(self, h):
+        return ['{:g}'.format(b) for b in h.buckets] + ['+Inf']
+
+    def transitions_items(self):
+        return [(tuple(k.split('->')),v) for k,v in self.transitions.items()]
+
+METRICS_TYPES = [
+    ('wwalker_stage_seconds','histogram'),
+    ('wwalker_messages_total','counter'),
+    ('wwalker_transitions_total','counter'),
+    ('wwalker_buttons_total','counter'),
+    ('wwalker_reply_delay_seconds','summary'),
+    ('wwalker_km_total','counter'),
+    ('wwalker_flood_waits_total','counter'),
+    ('wwalker_flood_wait_seconds_total','counter'),
+    ('wwalker_uptime_seconds','gauge'),
+    ('wwalker_account_total','counter')
+]
+
+def metrics_text(accounts):
+    """ prometheus exposition of all the accounts. lines of one metric are kept together """
+    lines = []
+    for a in accounts:
+        name = a.name if a.name is not None else ''
+        lines += a.fsm.metrics.prometheus(name)
+        for k,v in a.counters.items():
+            lines.append('wwalker_account_total{account="%s",counter="%s"} %d' % (name,k,v))
+    s = ''
+    for metric,t in METRICS_TYPES:
+        s += '# TYPE {} {}\n'.format(metric,t)
+        for l in lines:
+            if l.startswith(metric + '{') or l.startswith(metric + '_'):
+                s += l + '\n'
+    return s
+
+async def start_metrics_export(cfg, accounts, worker_idx = None):
+    """
+    [metrics] port = N serves prometheus text on 127.0.0.1, file = FILE rewrites it periodically.
+    supervisor workers use port + worker index and FILE.worker index
+    """
+    port = cfg.getint('port', 0)
+    if port:
+        port += worker_idx or 0
+
+        async def serve(reader, writer):
+            try:
+                #skip request line and headers
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), 5)
+                    if line in (b'', b'\r\n', b'\n'):
+                        break
+                body = metrics_text(accounts).encode()
+                writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n' % len(body))
+                writer.write(body)
+                await writer.drain()
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        await asyncio.start_server(serve, cfg.get('host', '127.0.0.1'), port)
+        log('metrics are served on port %d' % port)
+
+    filename = cfg.get('file')
+    if filename:
+        if worker_idx is not None:
+            filename += '.%d' % worker_idx
+
+        async def dump():
+            loop = asyncio.get_event_loop()
+            while True:
+                await loop.run_in_executor(disk_writer, atomic_write, filename, metrics_text(accounts))
+                await asyncio.sleep(METRICS_FILE_INTERVAL)
+
+        asyncio.ensure_future(dump())
+
+class TokenBucket:
+    """ sends rate limiter. pause() stops it completely, e.g. for telegram FloodWait """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """ take one token. returns seconds spent waiting for it """
+        waited = 0
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                delay = self.paused_until - now
+            else:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated)*self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens)/self.rate
+            await asyncio.sleep(delay)
+            waited += delay
+
+#shared by all the accounts of the process. set by setup_limits()
+global_limiter = None
+
+def setup_limits(cfg):
+    """ returns per account limiter factory """
+    global global_limiter
+    limits = cfg['limits'] if 'limits' in cfg else {}
+    rate = float(limits.get('rate', SEND_RATE))
+    burst = int(limits.get('burst', SEND_BURST))
+    global_limiter = TokenBucket(float(limits.get('global_rate', GLOBAL_SEND_RATE)), int(limits.get('global_burst', GLOBAL_SEND_BURST)))
+    return lambda: TokenBucket(rate, burst)
+
+class Profiling:
+    """
+    process wide cProfile and tracemalloc windows opened from the ctl chat.
+    nothing is hooked while they are off
+    """
+
+    def __init__(self):
+        self.profile = None
+        self.profile_started = None
+        self.mem_baseline = None
+        self.mem_started = None
+
+    def dump_name(self, kind, ext):
+        os.makedirs(PROFILING_DIR, exist_ok = True)
+        return os.path.join(PROFILING_DIR, '{}-{}-{}.{}'.format(kind, os.getpid(), time.strftime('%Y%m%d-%H%M%S'), ext))
+
+    def status(self, started):
+        if started is None:
+            return 'off'
+        return 'running for {}s'.format(int(time.time() - started))
+
+    def start_cpu(self):
+        if self.profile:
+            return 'cpu profiling is already running'
+        self.profile = cProfile.Profile()
+        self.profile_started = time.time()
+        self.profile.enable()
+        return 'cpu profiling started'
+
+    async def stop_cpu(self, top):
+        if not self.profile:
+            return 'cpu profiling is not running'
+        profile = self.profile
+        profile.disable()
+        self.profile = None
+        duration = time.time() - self.profile_started
+        self.profile_started = None
+
+        def dump():
+            filename = self.dump_name('cpu', 'pstats')
+            profile.dump_stats(filename)
+            out = io.StringIO()
+            pstats.Stats(profile, stream = out).strip_dirs().sort_stats('cumulative').print_stats(top)
+            return filename, out.getvalue()
+
+        filename, summary = await asyncio.get_event_loop().run_in_executor(disk_writer, dump)
+        log('cpu profile saved to %s' % filename)
+        return 'cpu profile for {}s saved to {}\n{}'.format(int(duration), filename, summary.strip())
+
+    def start_mem(self):
+        if self.mem_baseline:
+            return 'memory tracing is already running'
+        if tracemalloc.is_tracing():
+            return 'tracemalloc is started outside of ctl commands. ignored'
+        tracemalloc.start(PROFILING_MEM_FRAMES)
+        self.mem_baseline = tracemalloc.take_snapshot()
+        self.mem_started = time.time()
+        return 'memory tracing started'
+
+    async def stop_mem(self, top):
+        if not self.mem_baseline:
+            return 'memory tracing is not running'
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        baseline = self.mem_baseline
+        self.mem_baseline = None
+        duration = time.time() - self.mem_started
+        self.mem_started = None
+
+        def dump():
+            filename = self.dump_name('mem', 'tracemalloc')
+            snapshot.dump(filename)
+            skip = (tracemalloc.Filter(False, tracemalloc.__file__),)
+            diff = snapshot.filter_traces(skip).compare_to(baseline.filter_traces(skip), 'lineno')
+            return filename, '\n'.join([str(stat) for stat in diff[:top]])
+
+        filename, summary = await asyncio.get_event_loop().run_in_executor(disk_writer, dump)
+        log('memory snapshot saved to %s' % filename)
+        return 'memory growth for {}s (traced {} KiB, peak {} KiB) saved to {}\n{}'.format(
+            int(duration), current//1024, peak//1024, filename, summary)
+
+profiling = Profiling()
+
+class Scheduler:
+    """
+    outbound commands queue. every command carries due time and priority,
+    the single drain task sends them one by one, so events handlers never sleep
+    """
+
+    #no drain task, commands are sent by flush() only (replay)
+    manual = False
+
+    class Entry:
+        def __init__(self, due, priority, seq, text, send, key, on_sent):
+            self.due = due
+            self.priority = priority
+            self.seq = seq
+            self.text = text
+            self.send = send
+            self.key = key
+            self.on_sent = on_sent
+            self.cancelled = False
+
+        def __lt__(self, other):
+            return (self.due,self.priority,self.seq) < (other.due,other.priority,other.seq)
+
+    def __init__(self, delay_factor = 1):
+        #delays multiplier. 0 sends everything immediately (replay, load tests)
+        self.delay_factor = delay_factor
+        self.queue = []
+        self.keys = dict()
+        self.seq = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def time(self):
+        return time.monotonic()
+
+    def pending(self):
+        return sorted([e for e in self.queue if not e.cancelled])
+
+    def tail(self, priority):
+        """ due time of the last pending command not less urgent than priority """
+        return max([e.due for e in self.queue if not e.cancelled and e.priority <= priority], default = None)
+
+    def schedule(self, text, send, delay = 0, priority = 0, key = None, on_sent = None, after_pending = False):
+        """
+        queue text to be sent with send(text) after delay seconds.
+        pending command with the same key is replaced.
+        after_pending counts delay from the last pending command with the same or
+        more urgent priority instead of now. so replies never wait for long polls
+        """
+        if key:
+            self.cancel(key)
+
+        start = self.time()
+        if after_pending:
+            tail = self.tail(priority)
+            if tail and tail > start:
+                start = tail
+
+        self.seq += 1
+        entry = self.Entry(start + delay*self.delay_factor, priority, self.seq, text, send, key, on_sent)
+        heapq.heappush(self.queue, entry)
+        if key:
+            self.keys[key] = entry
+
+        if not self.manual and (self.task is None or self.task.done()):
+            self.task = asyncio.ensure_future(self.run())
+        self.wakeup.set()
+        return entry
+
+    def cancel(self, key = None):
+        """ cancel pending command by key or all pending commands. returns cancelled commands count """
+        if key:
+            entry = self.keys.pop(key, None)
+            if not entry or entry.cancelled:
+                return 0
+            entry.cancelled = True
+            return 1
+
+        n = 0
+        for e in self.queue:
+            if not e.cancelled:
+                e.cancelled = True
+                n += 1
+        self.keys.clear()
+        return n
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            while self.queue and self.queue[0].cancelled:
+                heapq.heappop(self.queue)
+
+            self.wakeup.clear()
+
+            if not self.queue:
+                await self.wakeup.wait()
+                continue
+
+            timeout = self.queue[0].due - self.time()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self.send_entry(heapq.heappop(self.queue))
+
+    async def send_entry(self, entry):
+        if entry.key and self.keys.get(entry.key) is entry:
+            del self.keys[entry.key]
+
+        try:
+            await entry.send(entry.text)
+        except Exception as e:
+            log_error('🖕failed to send %s: %s' % (entry.text,e))
+            return
+
+        if entry.on_sent:
+            entry.on_sent(entry)
+
+    async def flush(self, keep = ()):
+        """
+        send pending commands right away in their order. every text in keep holds back
+        one of the latest pending commands with this text, so the queue ends up as it was seen live
+        """
+        keep = list(keep)
+        held = set()
+        for entry in reversed(self.pending()):
+            if entry.text in keep:
+                keep.remove(entry.text)
+                held.add(entry)
+
+        later = []
+        while self.queue:
+            entry = heapq.heappop(self.queue)
+            if entry.cancelled:
+                continue
+            if entry in held:
+                later.append(entry)
+                continue
+            await self.send_entry(entry)
+        for entry in later:
+            heapq.heappush(self.queue, entry)
+
+    def __str__(self):
+        entries = self.pending()
+        if not entries:
+            return 'no pending commands\n'
+        now = self.time()
+        s = ''
+        for e in entries:
+            s += '{} in {}s{}\n'.format(e.text, max(0,int(e.due - now)), ' ({})'.format(e.key) if e.key else '')
+        return s
+
+class TimerWheel:
+    """
+    hierarchical timing wheel. one wheel per events loop serves timers of all the accounts:
+    arming, re-arming and cancelling a timer is O(1) and costs no asyncio task.
+    the wheel keeps one call_at() handle and ticks only while it has timers
+    """
+
+    BITS = 6
+    SLOTS = 1 << BITS
+    MASK = SLOTS - 1
+    LEVELS = 4
+
+    class Timer:
+        def __init__(self, wheel, callback):
+            self.wheel = wheel
+            self.callback = callback
+            self.expires = None
+            #set of the wheel the timer is linked to. None - not armed
+            self.slot = None
+
+        def reset(self, delay):
+            self.wheel.add(self, delay)
+
+        def cancel(self):
+            self.wheel.remove(self)
+
+        def active(self):
+            return self.slot is not None
+
+        def remaining(self):
+            if self.slot is None:
+                return None
+            return max(0, self.wheel.started + self.expires*self.wheel.resolution - self.wheel.loop.time())
+
+    def __init__(self, loop, resolution = TIMER_WHEEL_RESOLUTION):
+        self.loop = loop
+        self.resolution = resolution
+        self.levels = [[set() for i in range(self.SLOTS)] for l in range(self.LEVELS)]
+        self.started = loop.time()
+        #next tick to process
+        self.tick = 1
+        self.count = 0
+        self.handle = None
+
+    def timer(self, callback):
+        return self.Timer(self, callback)
+
+    def now_tick(self):
+        return int((self.loop.time() - self.started)/self.resolution)
+
+    def place(self, timer):
+        delta = timer.expires - self.tick
+        if delta < 0:
+            slot = self.levels[0][self.tick & self.MASK]
+        else:
+            level = 0
+            while level < self.LEVELS - 1 and delta >= 1 << (self.BITS*(level + 1)):
+                level += 1
+            expires = timer.expires
+            if delta >= 1 << (self.BITS*self.LEVELS):
+                #too far away. cascaded down again when the top level slot comes
+                expires = self.tick + (1 << (self.BITS*self.LEVELS)) - 1
+            slot = self.levels[level][(expires >> (self.BITS*level)) & self.MASK]
+        slot.add(timer)
+        timer.slot = slot
+
+    def add(self, timer, delay):
+        self.remove(timer)
+        if not self.count:
+            self.tick = self.now_tick() + 1
+        timer.expires = self.tick + max(0, math.ceil(delay/self.resolution) - 1)
+        self.place(timer)
+        self.count += 1
+        if self.handle is None:
+            self.handle = self.loop.call_at(self.started + self.tick*self.resolution, self.on_tick)
+
+    def remove(self, timer):
+        if timer.slot is None:
+            return
+        timer.slot.discard(timer)
+        timer.slot = None
+        self.count -= 1
+
+    def run_tick(self):
+        index = self.tick & self.MASK
+        level = 1
+        #move timers of the upper level slot down when the lower level wraps
+        while index==0 and level < self.LEVELS:
+            index = (self.tick >> (self.BITS*level)) & self.MASK
+            slot = self.levels[level][index]
+            self.levels[level][index] = set()
+            for t in slot:
+                self.place(t)
+            level += 1
+
+        index = self.tick & self.MASK
+        expired = self.levels[0][index]
+        self.levels[0][index] = set()
+        self.tick += 1
+
+        for t in list(expired):
+            #cancelled or re-armed by the previous callback
+            if t.slot is not expired:
+                continue
+            t.slot = None
+            self.count -= 1
+            try:
+                t.callback()
+            except Exception as e:
+                log_error('timer callback failed: %s' % e)
+
+    def on_tick(self):
+        now = self.now_tick()
+        while self.count and self.tick <= now:
+            self.run_tick()
+        if self.count:
+            self.handle = self.loop.call_at(self.started + self.tick*self.resolution, self.on_tick)
+        else:
+            self.handle = None
+
+    def __len__(self):
+        return self.count
+
+timer_wheels = weakref.WeakKeyDictionary()
+
+def timer_wheel():
+    """ the wheel of the current events loop """
+    loop = asyncio.get_event_loop()
+    wheel = timer_wheels.get(loop)
+    if wheel is None:
+        wheel = timer_wheels[loop] = TimerWheel(loop)
+    return wheel
+
+class EnergyModel:
+    """
+    learns how long it takes to regenerate one energy point after exhaustion.
+    pip-boy readings bracket it between the longest wait with zero energy (lo)
+    and the shortest wait with energy restored (hi). next wake up probes the middle
+    of the bracket, so it narrows with every exhaustion
+    """
+
+    def __init__(self):
+        self.lo = 0
+        self.hi = None
+        #current exhaustion episode start and whether zero energy was seen during it
+        self.started = None
+        self.missed = False
+
+    def on_exhausted(self, now):
+        if self.started is None:
+            self.started = now
+            self.missed = False
+
+    def cancel(self):
+        """ exhaustion episode ended without recovery reading """
+        self.started = None
+        self.missed = False
+
+    def on_reading(self, now, energy):
+        if self.started is None:
+            return
+        elapsed = now - self.started
+        if elapsed > ENERGY_RECOVERY_MAX:
+            #stale episode start. learn from the next one
+            self.started = now if energy==0 else None
+            self.missed = False
+            return
+        if energy==0:
+            if self.hi is not None and elapsed >= self.hi:
+                #regeneration became slower. forget the upper bound
+                self.hi = None
+            self.lo = max(self.lo, elapsed)
+            self.missed = True
+            return
+        if elapsed <= self.lo:
+            #regeneration became faster. forget the lower bound
+            self.lo = 0
+        elif not self.missed:
+            #recovered at the first try. widen the bracket a bit to notice faster regeneration
+            self.lo = max(0, self.lo - ENERGY_ETA_MARGIN)
+        self.hi = elapsed if self.hi is None else min(self.hi, elapsed)
+        self.started = None
+
+    def eta(self, now):
+        """ seconds until the next wake up or None if there is nothing to predict from """
+        if self.hi is None or self.started is None:
+            return None
+        elapsed = now - self.started
+        target = self.hi
+        if self.hi - self.lo > 2*ENERGY_ETA_MARGIN and elapsed < (self.lo + self.hi)/2:
+            target = (self.lo + self.hi)/2
+        if elapsed > self.hi + ENERGY_ETA_MARGIN:
+            #prediction missed
+            return None
+        return max(0, target - elapsed)
+
+    def __str__(self):
+        if self.hi is None:
+            return 'unknown'
+        return '{:.0f}-{:.0f}s'.format(self.lo, self.hi)
+
+    def to_dict(self):
+        return { 'lo': self.lo, 'hi': self.hi, 'started': self.started, 'missed': self.missed }
+
+    def from_dict(self, d):
+        self.lo = d['lo']
+        self.hi = d['hi']
+        self.started = d['started']
+        self.missed = d['missed']
+
+class GiantModel:
+    """ hp time series of the current giant battle. predicts when hp drops below zero """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        #(time,hp) of the latest readings
+        self.readings = []
+        self.max_hp = None
+        self.backoff = None
+
+    def on_reading(self, now, hp, max_hp):
+        if max_hp!=self.max_hp or (self.readings and hp > self.readings[-1][1]):
+            #another giant
+            self.reset()
+            self.max_hp = max_hp
+        self.readings.append((now,hp))
+        del self.readings[:-GIANT_SAMPLES]
+
+    def rate(self):
+        """ damage per second or None if unknown """
+        if len(self.readings) < 2:
+            return None
+        (t0,hp0), (t1,hp1) = self.readings[0], self.readings[-1]
+        if t1 <= t0:
+            return None
+        return (hp0 - hp1)/(t1 - t0)
+
+    def next_poll(self, now):
+        """ delay of the next poll or None if there is not enough data """
+        rate = self.rate()
+        if rate is None:
+            return None
+        if rate <= 0 or self.readings[-1][1]==self.readings[-2][1]:
+            #hp does not move between readings. back off until the battle goes on
+            self.backoff = min(GIANT_POLL_MAX, 2*(self.backoff or GIANT_POLL_INTERVAL[1]))
+            return self.backoff
+        self.backoff = None
+        t, hp = self.readings[-1]
+        #missed prediction gives eta <= 0. the giant is close to defeat, so poll it soon again,
+        #the new reading corrects the rate
+        eta = hp/rate - (now - t)
+        return min(GIANT_POLL_MAX, max(GIANT_POLL_MIN, eta))
+
+    def __str__(self):
+        if not self.readings:
+            return 'no battle'
+        rate = self.rate()
+        return '{}/{} hp, {} hp/hour'.format(self.readings[-1][1], self.max_hp, int(rate*3600) if rate is not None else 'unknown')
+
+    def to_dict(self):
+        return { 'readings': self.readings, 'max_hp': self.max_hp, 'backoff': self.backoff }
+
+    def from_dict(self, d):
+        self.readings = [tuple(r) for r in d['readings']]
+        self.max_hp = d['max_hp']
+        self.backoff = d['backoff']
 
 class FSM:
 
@@ -410,51 +1646,56 @@ class FSM:
         Exhausted = 4
         Giant = 5
 
-    def cancel_inactivity_timer(self):
-        return
-        if self.inactivity_timer_task:
-            self.inactivity_timer_task.cancel()
-            self.inactivity_timer_task = None
-            log('⏳inactivity timer is cancelled')
+    def log(self, msg):
+        log(self.log_prefix + msg)
 
-    def reset_inactivity_timer(self,event):
-        return
-        self.cancel_inactivity_timer()
-
-        def inactivity_timer_done_callback(f):
-            try:
-                r = f.result()
-            except:
-                pass
+    def log_debug(self, msg, *args):
+        if logger.isEnabledFor(logging.DEBUG):
+            log_debug(self.log_prefix + msg, *args)
 
-        log('⏳%s set inactivity timer' % event.message.id)
+    def log_error(self, msg):
+        log_error(self.log_prefix + msg)
 
-        self.inactivity_timer_task = asyncio.ensure_future(self.inactivity_timer_handler(event))
-        self.inactivity_timer_task.add_done_callback(inactivity_timer_done_callback)
-
-    async def inactivity_timer_handler(self,event):
-        return
-        try:
-            delay = random.randint(int(INACTIVITY_POLL_TIMEOUT*0.9),int(INACTIVITY_POLL_TIMEOUT*1.1))
-            log('⏳%s inactivity timer delay: %s' % (event.message.id,delay))
-            if os.name == 'nt': #TODO: check what is wrong with asyncio.sleep on windows
-                time.sleep(delay)
-            else:
-                await asyncio.sleep(delay)
-            await self.on_inactivity_timer(event)
-        except:
-            return
+    def cancel_inactivity_timer(self):
+        #known answer from the game. recovery attempts start over
+        self.watchdog_retries = 0
+        if self.watchdog and self.watchdog.active():
+            self.watchdog.cancel()
+            self.log('⏳inactivity timer is cancelled')
 
-    async def on_inactivity_timer(self,event):
-        return
-        log('⏳inactivity timer is fired')
+    def reset_inactivity_timer(self,event):
+        """ (re)arm the watchdog. the game is expected to answer the command just sent """
+        self.watchdog_send = event.respond
+        self.arm_watchdog(INACTIVITY_POLL_TIMEOUT)
+        self.log_debug('⏳%s inactivity timer is set' % event.message.id)
+
+    def arm_watchdog(self, timeout):
+        if self.watchdog is None:
+            #looked up on every call, so hot reloaded code is used
+            self.watchdog = timer_wheel().timer(lambda: self.on_inactivity_timer())
+        self.watchdog.reset(random.randint(int(timeout*0.9),int(timeout*1.1)))
+
+    def on_inactivity_timer(self):
+        self.log('⏳inactivity timer is fired')
         if not self.enabled:
-            log('⏳ignore timer because of disabled events processing')
+            self.log('⏳ignore timer because of disabled events processing')
             return
         if self.skip_buttons:
-            log('⏳ignore timer because of disabled buttons processing')
+            self.log('⏳ignore timer because of disabled buttons processing')
+            return
+        if self.scheduler.pending():
+            self.log('⏳pending commands. check again later')
+            self.arm_watchdog(INACTIVITY_POLL_TIMEOUT)
+            return
+        if self.watchdog_retries >= INACTIVITY_RETRIES:
+            self.log_error('⏳no answer to %s recovery commands. give up until the next known message' % self.watchdog_retries)
             return
-        await self.delayed_reply(event,'🔎Действие')
+        self.watchdog_retries += 1
+        timeout = INACTIVITY_POLL_TIMEOUT*2**self.watchdog_retries
+
+        #the recovery may be lost too. the watchdog watches it as any other command
+        self.send_command(self.watchdog_send, '🔎Действие', random.randint(MIN_RESPONSE_DELAY,MAX_RESPONSE_DELAY), 'watchdog',
+            lambda: self.arm_watchdog(timeout))
 
     def on_go_further(self, event, button):
         if self.state!=self.State.Journey:
@@ -470,8 +1711,8 @@ class FSM:
     def on_cowardice(self, event, button):
         if self.parser.matched_message!=Parser.MatchedMessage.WastelandLocation:
             return None
-        if self.parser.km:
-            if self.p().cowardice.get(int(self.parser.km)):
+        if self.parser.km is not None:
+            if self.p().cowardice.get(self.parser.km):
                 return button
         return None
 
@@ -511,8 +1752,8 @@ class FSM:
     def on_darkzone(self, event, button):
         if self.parser.matched_message!=Parser.MatchedMessage.WastelandLocation:
             return None
-        if self.parser.km:
-            km = int(self.parser.km)
+        if self.parser.km is not None:
+            km = self.parser.km
             if km in self.p().darkzone_autoenter and self.p().darkzone_autoenter[km]:
                 return button
         return None
@@ -520,19 +1761,22 @@ class FSM:
     def on_dunge_enter(self, event, button):
         if self.parser.matched_message!=Parser.MatchedMessage.WastelandLocation:
             return None
-        if self.parser.km:
-            km = int(self.parser.km)
+        if self.parser.km is not None:
+            km = self.parser.km
             if km in self.p().dungeons_autoenter and self.p().dungeons_autoenter[km]:
                 return button
         return None
 
+    #ascii look-alikes occasionally used by the game instead of cyrillic letters
+    BUTTON_TEXT_FOLD = str.maketrans('aceopxy','асеорху')
+
     class Button:
         def __init__(self, name, handler):
             self.name = name
             self.handler = handler
 
-        def match(self, key):
-            return self.name==key
+        def key(self):
+            return self.name.translate(FSM.BUTTON_TEXT_FOLD)
 
         def process(self, fsm, event, button):
             return self.handler(fsm, event, button)
@@ -546,13 +1790,15 @@ class FSM:
         Button('🚷В Темную зону',on_darkzone),
         Button('🔫Выстрелить',on_shoot),
         Button('👣Идти дальше',on_go_further),
-        Button('👣Идти дaльше',on_go_further), #changed 'a' to ascii
         Button('Двигаться дальше',on_dunge_go_further),
         Button('Идти вглубь',on_dunge_go_further),
         Button('🏃Дать деру',on_cowardice),
         Button('⚔️Дать отпор',on_fight)
     ]
     DUNGEONS_BUTTON_INSERT_IDX = 2
+    buttons_index = None
+    #folded reply text -> delay category. see reply_category()
+    reply_categories = None
 
     dungeons = {
         11: "Старая шахта",
@@ -570,29 +1816,68 @@ class FSM:
         80: "🔥Огненные недра"
     }
 
-    profiles = dict()
-
     def p(self, idx = None):
         if idx is None:
             idx = self.active_profile
-        return self.profiles[idx]
+        try:
+            return self.profiles[idx]
+        except KeyError:
+            if self.store is None:
+                raise
+        return self.fetch_profile(idx)
+
+    def fetch_profile(self, idx):
+        """ lazy load from the store on the first access """
+        data = self.store.get(self.store_key, idx)
+        if data is None:
+            raise KeyError(idx)
+        profile = Profile()
+        profile.load(self, data)
+        self.profiles[idx] = profile
+        return profile
+
+    def has_profile(self, idx):
+        if idx in self.profiles:
+            return True
+        if self.store is None:
+            return False
+        try:
+            self.fetch_profile(idx)
+        except KeyError:
+            return False
+        return True
+
+    def profile_indexes(self):
+        if self.store is None:
+            return sorted(self.profiles.keys())
+        return sorted(set(self.profiles.keys()) | set(self.store.indexes(self.store_key)))
 
     def load_profiles(self):
-        if os.path.isdir(PROFILES_DIR):
-            flist = [f for f in os.listdir(PROFILES_DIR)]
+        if self.store is not None:
+            self.load_profiles_from_store()
+            return
+
+        if self.profiles_dir is None:
+            #in-memory default profile (replay, benchmarks)
+            self.profiles[0] = Profile()
+            self.active_profile = 0
+            self.p().load_from_file(self, None)
+            return
+
+        if os.path.isdir(self.profiles_dir):
+            #skip leftovers like temporary files of interrupted saves
+            flist = [f for f in os.listdir(self.profiles_dir) if f.isdigit() and os.path.isfile(self.profile_path(f))]
             if flist:
-                print('load {} profiles'.format(len(flist)))
+                self.log('load {} profiles'.format(len(flist)))
                 for f in flist:
                     profile_idx = int(f)
-                    profile_path = PROFILES_DIR + '/' + f
-                    if not os.path.isfile(profile_path):
-                        continue
+                    profile_path = self.profile_path(f)
                     self.profiles[profile_idx] = Profile()
                     self.profiles[profile_idx].load_from_file(self,profile_path)
                 self.active_profile = sorted(self.profiles.keys())[0]
                 return
         else:
-            os.mkdir(PROFILES_DIR)
+            os.mkdir(self.profiles_dir)
 
         if self.profiles:
             return
@@ -602,60 +1887,626 @@ class FSM:
         self.profiles[0] = Profile()
         self.active_profile = 0
         self.p().load_from_file(self, None)
-        self.p().save_to_file(PROFILES_DIR + '/' + str(self.active_profile))
+        self.p().save_to_file(self.profile_path(self.active_profile))
+
+    def load_profiles_from_store(self):
+        #profiles are fetched on demand. startup does not depend on their count
+        first = self.store.first(self.store_key)
+        if first is None and self.profiles_dir is not None:
+            n = self.store.migrate(self.store_key, self.profiles_dir)
+            if n:
+                self.log('migrated {} profiles from {} to {}'.format(n, self.profiles_dir, self.store.filename))
+                first = self.store.first(self.store_key)
+
+        if first is not None:
+            self.active_profile = first
+            return
+
+        self.profiles[0] = Profile()
+        self.active_profile = 0
+        self.p().load(self, None)
+        self.store.put(self.store_key, [(0, self.p().dump())])
+
+    def profile_path(self, idx):
+        return '{}/{}'.format(self.profiles_dir,idx)
+
+    def write_profiles(self, writes):
+        """ writes: list of (idx,data) """
+        if self.store is not None:
+            self.store.put(self.store_key, writes)
+            return
+        for idx,data in writes:
+            filename = self.profile_path(idx)
+            log('save to file: %s' % filename)
+            atomic_write(filename, data)
+
+    def remove_profile(self, idx):
+        del self.profiles[idx]
+        if self.store is not None:
+            self.store.delete(self.store_key, idx)
+            return
+        try:
+            os.remove(self.profile_path(idx))
+        except:
+            pass
 
     def save_profiles(self):
+        """ write changed profiles """
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.profiles_dir is None and self.store is None:
+            return
+        writes = []
         for idx,p in self.profiles.items():
-            p.save_to_file(PROFILES_DIR + '/' + str(idx))
+            if p.dirty:
+                writes.append((idx, p.dump()))
+                p.dirty = False
+        if not writes:
+            return
+        #queued after the pending background writes, so they can not overwrite it
+        try:
+            disk_writer.submit(self.write_profiles, writes).result()
+        except Exception as e:
+            self.log_error('failed to save profiles: %s' % e)
+            self.mark_unsaved(writes)
+
+    def profile_changed(self, idx = None):
+        """
+        mark profile as dirty and postpone the flush,
+        so the burst of edits is coalesced into the single write
+        """
+        if idx is None:
+            idx = self.active_profile
+        self.p(idx).touch()
 
-    def __init__(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save_profiles()
+            return
+
+        if self.flush_handle:
+            self.flush_handle.cancel()
+        self.flush_handle = loop.call_later(PROFILES_FLUSH_DELAY, self.flush_profiles)
 
-        self.runtime_version = self.on_version(None,None,True)
+    def flush_profiles(self):
+        self.flush_handle = None
+        if self.profiles_dir is None and self.store is None:
+            return
+
+        #serialize in the loop thread to get consistent snapshot, write in the executor
+        writes = []
+        for idx,p in self.profiles.items():
+            if p.dirty:
+                writes.append((idx, p.dump()))
+                p.dirty = False
+
+        if writes:
+            future = asyncio.get_running_loop().run_in_executor(disk_writer, self.write_profiles, writes)
+            future.add_done_callback(lambda f: self.on_profiles_written(f, writes))
+
+    def on_profiles_written(self, future, writes):
+        if future.cancelled() or future.exception() is None:
+            return
+        self.log_error('failed to save profiles: %s. retry in %ss' % (future.exception(),PROFILES_RETRY_DELAY))
+        self.mark_unsaved(writes)
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(PROFILES_RETRY_DELAY, self.flush_profiles)
+
+    def mark_unsaved(self, writes):
+        for idx,data in writes:
+            if idx in self.profiles:
+                self.profiles[idx].dirty = True
+
+    def build_buttons_index(self):
+        #folded button text -> (priority,Button). dungeons buttons go right after the go home ones
+        catalog = list(self.buttons)
+        for name in self.dungeons.values():
+            catalog.insert(self.DUNGEONS_BUTTON_INSERT_IDX, self.Button(name,FSM.on_dunge_enter))
+
+        index = dict()
+        for priority,b in enumerate(catalog):
+            index.setdefault(b.key(),(priority,b))
+        return index
+
+    def build_reply_categories(self):
+        index = { k.translate(self.BUTTON_TEXT_FOLD): v for k,v in self.REPLY_CATEGORIES.items() }
+        for name in self.dungeons.values():
+            index.setdefault(name.translate(self.BUTTON_TEXT_FOLD), 'enter')
+        return index
+
+    def __init__(self, name = None, profiles_dir = PROFILES_DIR, store = None):
+
+        self.name = name
+        self.log_prefix = '' if name is None else '[%s] ' % name
+        self.profiles_dir = profiles_dir
+        #loaded profiles. with the store it is the cache filled by p()
+        self.profiles = dict()
+        self.store = store
+        self.store_key = name if name is not None else ''
+        self.flush_handle = None
 
         self.enabled = True
         self.parser = Parser()
         self.state = self.State.Journey
+        self.sub_state = 0
+        self.prev_state = None
         self.skip_buttons = False
-        self.inactivity_timer_task = None
+        #inactivity watchdog. TimerWheel.Timer, created on first use
+        self.watchdog = None
+        self.watchdog_send = None
+        self.watchdog_retries = 0
+        self.maintenance_task = None
 
         self.food_requested = False
-
-        #init dounges buttons callbacks
-        for name in self.dungeons.values():
-            self.buttons.insert(self.DUNGEONS_BUTTON_INSERT_IDX, self.Button(name,FSM.on_dunge_enter))
+        #food commands queued but not sent yet
+        self.food_pending = 0
+        #local copy of the food listing, decremented on every sent /use_. None - unknown
+        self.food_cache = None
+        #{'hunger','items'} of the last meal, items are the sent ones. checked against the next hunger reading
+        self.meal = None
+        #food name -> hunger restored by one item, learned from readings
+        self.food_values = dict()
+
+        self.scheduler = Scheduler()
+        self.journal = None
+        self.metrics = Metrics()
+        #[day,count] of commands sent, for the daily budget
+        self.actions = [None,0]
+        #per account TokenBucket. None - no limits (replay, tests)
+        self.limiter = None
+        self.energy = EnergyModel()
+        self.giant = GiantModel()
+
+        #state snapshot file. see restore_checkpoint()
+        self.checkpoint_file = None
+        self.checkpoint_data = None
+        self.checkpoint_handle = None
+
+        #buttons index is immutable and shared by all the FSM instances
+        if FSM.buttons_index is None:
+            FSM.buttons_index = self.build_buttons_index()
+        if FSM.reply_categories is None:
+            FSM.reply_categories = self.build_reply_categories()
 
         self.load_profiles()
 
-    async def delayed_reply(self, event, reply, delay = None, skip_inactivity_timer = False):
+    def on_reloaded(self):
+        """
+        called after the class of the live FSM was replaced by the reloaded one.
+        enum members and nested objects are moved to the new classes here,
+        attributes introduced by the new code should get their initial values here too
+        """
+        for k,v in [('sub_state',0), ('prev_state',None), ('limiter',None), ('actions',[None,0]),
+                    ('checkpoint_file',None), ('checkpoint_data',None), ('checkpoint_handle',None),
+                    ('watchdog',None), ('watchdog_send',None), ('watchdog_retries',0), ('food_pending',0),
+                    ('food_cache',None), ('meal',None), ('food_values',dict())]:
+            self.__dict__.setdefault(k,v)
+        for k,cls in [('metrics',Metrics), ('energy',EnergyModel), ('giant',GiantModel)]:
+            if k not in self.__dict__:
+                setattr(self, k, cls())
+            getattr(self, k).__class__ = cls
+
+        self.state = self.State[self.state.name]
+        if self.prev_state is not None:
+            self.prev_state = self.State[self.prev_state.name]
+        self.parser.__class__ = Parser
+        self.parser.on_reloaded()
+        self.scheduler.__class__ = Scheduler
+        for p in self.profiles.values():
+            p.__class__ = Profile
+            p.on_reloaded()
+        if self.journal:
+            self.journal.__class__ = Journal
+        if FSM.buttons_index is None:
+            FSM.buttons_index = self.build_buttons_index()
+        if FSM.reply_categories is None:
+            FSM.reply_categories = self.build_reply_categories()
+
+    async def limited_send(self, send, text):
+        """
+        every outgoing message goes here. waits for account and global limiters,
+        FloodWait pauses this account only and the message is sent again after it
+        """
+        for attempt in range(FLOOD_WAIT_RETRIES + 1):
+            waited = 0
+            if self.limiter:
+                waited += await self.limiter.acquire()
+            if global_limiter:
+                waited += await global_limiter.acquire()
+            self.metrics.observe('throttle', waited)
+            try:
+                return await send(text)
+            except FloodWaitError as e:
+                self.metrics.flood_waits += 1
+                self.metrics.flood_wait_seconds += e.seconds
+                self.log_error('flood wait for %ss on sending: %s' % (e.seconds,text))
+                if attempt==FLOOD_WAIT_RETRIES:
+                    raise
+                if self.limiter:
+                    self.limiter.pause(e.seconds)
+                else:
+                    await asyncio.sleep(e.seconds)
+
+    REPLY_PRIORITY = 0
+    POLL_PRIORITY = 1
+
+    POLL_COMMANDS = {
+        State.Exhausted: '/me',
+        State.Giant: '🔎Действие'
+    }
+
+    CHECKPOINT_STATS = ['hp','max_hp','hunger','energy','max_energy','km','giant_hp','giant_max_hp']
+
+    def snapshot(self):
+        """ compact state to resume from after restart """
+        now = self.scheduler.time()
+        wall = time.time()
+        return {
+            'state': self.state.name,
+            'sub_state': self.sub_state,
+            'prev_state': self.prev_state.name if self.prev_state else None,
+            'skip_buttons': self.skip_buttons,
+            'food_requested': self.food_requested,
+            'actions': self.actions,
+            'food_values': self.food_values,
+            'food_cache': self.food_cache,
+            'meal': self.meal,
+            'energy': self.energy.to_dict(),
+            'giant': self.giant.to_dict(),
+            'stats': { k: getattr(self.parser,k) for k in self.CHECKPOINT_STATS },
+            'pending': [{ 'text': e.text, 'key': e.key, 'due': int(wall + max(0, e.due - now)) } for e in self.scheduler.pending()]
+        }
+
+    def request_checkpoint(self):
+        """
+        changes made within CHECKPOINT_FLUSH_DELAY are saved once.
+        the write is not postponed by further changes, so it is never later than that
+        """
+        if self.checkpoint_file is None or self.checkpoint_handle:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save_checkpoint()
+            return
+        self.checkpoint_handle = loop.call_later(CHECKPOINT_FLUSH_DELAY, self.save_checkpoint)
+
+    def save_checkpoint(self):
+        if self.checkpoint_handle:
+            self.checkpoint_handle.cancel()
+            self.checkpoint_handle = None
+        if self.checkpoint_file is None:
+            return
+        snapshot = self.snapshot()
+        data = json.dumps(snapshot, ensure_ascii = False, sort_keys = True)
+        if data==self.checkpoint_data:
+            return
+        self.checkpoint_data = data
+
+        snapshot['ts'] = int(time.time())
+        data = json.dumps(snapshot, ensure_ascii = False, sort_keys = True)
+        try:
+            future = asyncio.get_running_loop().run_in_executor(disk_writer, atomic_write, self.checkpoint_file, data)
+        except RuntimeError:
+            future = disk_writer.submit(atomic_write, self.checkpoint_file, data)
+        future.add_done_callback(self.on_checkpoint_written)
+
+    def on_checkpoint_written(self, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        self.log_error('failed to save checkpoint %s: %s' % (self.checkpoint_file,future.exception()))
+        #the next request writes it again
+        self.checkpoint_data = None
+
+    def apply_snapshot(self, snapshot):
+        """ set state saved by snapshot(). pending commands are left to the caller """
+        self.state = self.State[snapshot['state']]
+        self.sub_state = snapshot['sub_state']
+        self.prev_state = self.State[snapshot['prev_state']] if snapshot['prev_state'] else None
+        self.skip_buttons = snapshot['skip_buttons']
+        self.food_requested = snapshot['food_requested']
+        self.actions = snapshot.get('actions', self.actions)
+        self.food_values = snapshot.get('food_values', self.food_values)
+        self.food_cache = snapshot.get('food_cache', self.food_cache)
+        self.meal = snapshot.get('meal', self.meal)
+        if 'energy' in snapshot:
+            self.energy.from_dict(snapshot['energy'])
+        if 'giant' in snapshot:
+            self.giant.from_dict(snapshot['giant'])
+        for k,v in snapshot['stats'].items():
+            if k in self.CHECKPOINT_STATS:
+                setattr(self.parser,k,v)
+
+    def resume_pending(self, pending, send):
+        """ reschedule pending commands of snapshot() for their original due time """
+        for c in pending:
+            after_sent = None
+            if self.is_food_command(c['text']):
+                self.food_pending += 1
+                after_sent = self.on_food_sent
+            self.send_command(send, c['text'], max(0, c['due'] - time.time()), c['key'], after_sent)
+
+    def restore_checkpoint(self, send):
+        """
+        resume state saved by the previous run. pending commands are rescheduled
+        for their original due time and sent with send(text) as there is no event to reply to
+        """
+        if self.checkpoint_file is None or not os.path.isfile(self.checkpoint_file):
+            return False
+        try:
+            with open(self.checkpoint_file) as f:
+                snapshot = json.load(f)
+            age = time.time() - snapshot['ts']
+            if age > CHECKPOINT_MAX_AGE:
+                self.log('checkpoint is {}s old. ignore it'.format(int(age)))
+                return False
+
+            self.apply_snapshot(snapshot)
+            pending = snapshot['pending']
+        except (OSError, ValueError, KeyError) as e:
+            self.log_error('failed to load checkpoint %s: %s' % (self.checkpoint_file,e))
+            return False
+
+        self.resume_pending(pending, send)
+
+        #poll command was sent but the reply was lost with the previous instance
+        if not pending and self.state in self.POLL_COMMANDS:
+            self.send_command(send, self.POLL_COMMANDS[self.state], random.randint(MIN_RESPONSE_DELAY,MAX_RESPONSE_DELAY), 'poll')
+
+        self.log('resumed state {} with {} pending commands'.format(self.state.name,len(self.scheduler.pending())))
+        return True
+
+    def send_command(self, send, text, delay, key = None, after_sent = None):
+        """ schedule command which is not a reply to any event """
+        def on_sent(entry):
+            self.log('👌sent: %s' % text)
+            self.count_action()
+            if self.journal:
+                self.journal.write_outgoing(None, text)
+            if after_sent:
+                after_sent()
+            self.request_checkpoint()
+
+        async def limited(text):
+            await self.limited_send(send, text)
+
+        self.scheduler.schedule(text, limited, delay,
+            self.POLL_PRIORITY if key else self.REPLY_PRIORITY,
+            key, on_sent, True)
+
+    def delayed_reply(self, event, reply, delay = None, skip_inactivity_timer = False, key = None, after_sent = None):
+        """
+        queue reply to the outbound scheduler and return immediately.
+        replies are paced one after another, key allows to replace the pending one
+        """
         if not delay:
-            delay = random.randint(MIN_RESPONSE_DELAY,MAX_RESPONSE_DELAY)
+            delay = self.reply_delay(reply)
         elif isinstance(delay,tuple):
             delay = random.randint(delay[0],delay[1])
         else:
-            delay = random.randint(delay*0.8,delay*1.2)
+            delay = random.randint(int(delay*0.8),int(delay*1.2))
+
+        self.log('⏳%s postpone %s for %s seconds' % (event.message.id,reply,delay))
+
+        metrics = self.metrics
+        scheduled = time.perf_counter()
+        event_id, received = metrics.last_event
+        if event_id!=event.message.id:
+            received = None
+
+        async def send(text):
+            started = time.perf_counter()
+            metrics.observe('delay', started - scheduled)
+            await self.limited_send(event.respond, text)
+            now = time.perf_counter()
+            metrics.observe('respond', now - started)
+            if received is not None:
+                metrics.observe('reaction', now - received)
+
+        def on_sent(entry):
+            self.log('👌%s sent: %s' % (event.message.id,reply))
+            self.count_action()
+            if self.journal:
+                self.journal.write_outgoing(event.message.id, reply)
+            if after_sent:
+                after_sent()
+            if not skip_inactivity_timer:
+                self.reset_inactivity_timer(event)
+            self.request_checkpoint()
+
+        self.scheduler.schedule(reply, send, delay,
+            self.POLL_PRIORITY if key else self.REPLY_PRIORITY,
+            key, on_sent, True)
+        self.request_checkpoint()
+
+    REPLY_CATEGORIES = {
+        '👣Идти дальше': 'walk',
+        'Двигаться дальше': 'walk',
+        'Идти вглубь': 'walk',
+        '👣Пустошь': 'walk',
+        '🔜12 км': 'walk',
+        '🔜22 км': 'walk',
+        '🔜31 км': 'walk',
+        '⚔️Дать отпор': 'fight',
+        '🏃Дать деру': 'fight',
+        '⚔️Атаковать': 'fight',
+        '🔫Выстрелить': 'fight',
+        '⛺️Вернуться': 'home',
+        'Вернуться в лагерь': 'home',
+        '🚷В Темную зону': 'enter',
+        '/myfood': 'food',
+        '💉++ Суперстим': 'campus',
+        '💊Speed-ы': 'campus',
+        '/deeprest': 'campus'
+    }
 
-        log('⏳%s postpone %s for %s seconds' % (event.message.id,reply,delay))
+    def reply_category(self, reply):
+        category = self.reply_categories.get(reply.translate(self.BUTTON_TEXT_FOLD))
+        if category:
+            return category
+        if reply.startswith('/use_'):
+            return 'food'
+        return 'default'
+
+    def reply_delay(self, reply):
+        """ delay drawn from the profile range for reply category, scaled by km """
+        category = self.reply_category(reply)
+        lo, hi = self.p().get_delay(category)
+        km = self.parser.km if self.parser.km is not None else 0
+        delay = round(random.uniform(lo,hi)*self.p().delay_km.get(km)/100, 1)
+        self.metrics.on_delay(category, delay)
+        return delay
+
+    def count_action(self):
+        day = datetime.date.today().isoformat()
+        if self.actions[0]!=day:
+            self.actions = [day,0]
+        self.actions[1] += 1
+
+    def actions_today(self):
+        return self.actions[1] if self.actions[0]==datetime.date.today().isoformat() else 0
+
+    def food_restore(self, name):
+        return self.food_values.get(name, FOOD_RESTORE_DEFAULT)
+
+    def plan_meal(self, need):
+        """
+        the fewest allowed cached items restoring at least need hunger points,
+        with the least overshoot among them. all allowed items if they are not enough.
+        returns list of cache entries, the same entry is repeated for several items
+        """
+        if self.food_cache is None or need <= 0:
+            return None
+        allowed = [f for f in self.food_cache if not self.p().is_food_blacklisted(f['name'])]
+        units = sorted([(max(1,int(round(self.food_restore(f['name'])))),i) for i,f in enumerate(allowed) for c in range(f['count'])], reverse = True)
+        if not units:
+            return None
 
-        if os.name == 'nt': #TODO: check what is wrong with asyncio.sleep on windows
-            time.sleep(delay)
+        #the largest items first give the fewest items count
+        total = 0
+        for k,(v,i) in enumerate(units):
+            total += v
+            if total >= need:
+                break
         else:
-            await asyncio.sleep(delay)
+            return [allowed[i] for v,i in units]
+        k += 1
+
+        #sets of k items by restored sum. the least sum not below need wins
+        sums = [dict() for j in range(k + 1)]
+        sums[0][0] = ()
+        for v,i in units:
+            for j in range(k - 1, -1, -1):
+                for s,items in list(sums[j].items()):
+                    sums[j + 1].setdefault(s + v, items + (i,))
+        s = min([s for s in sums[k] if s >= need])
+        return [allowed[i] for i in sums[k][s]]
+
+    @staticmethod
+    def is_food_command(text):
+        return text=='/myfood' or text.startswith('/use_')
+
+    def on_food_sent(self, food = None):
+        """ food command left the queue. an eaten item is taken from the cache and added to the meal """
+        self.food_pending = max(0, self.food_pending - 1)
+        if food is None:
+            return
+        if self.food_cache is not None:
+            for f in self.food_cache:
+                if f['id']==food['id']:
+                    f['count'] -= 1
+            self.food_cache = [f for f in self.food_cache if f['count'] > 0]
+        if self.meal:
+            self.meal['items'].append(food['name'])
+
+    def eat(self, event, meal):
+        """ queue the whole meal as one burst of /use_ commands """
+        self.meal = { 'hunger': self.parser.hunger, 'items': [] }
+        for n,f in enumerate(meal):
+            self.food_pending += 1
+            self.delayed_reply(event,'/use_%s' % f['id'], MEAL_BURST_DELAY if n else None,
+                after_sent = lambda f=f: self.on_food_sent(f))
+
+    def learn_meal(self, event):
+        """ split hunger drop after the meal between its items proportionally to their estimates """
+        meal = self.meal
+        self.meal = None
+        if not meal['items']:
+            return
+        hunger = self.parser.hunger
+        drop = meal['hunger'] - hunger
+        if drop <= 0:
+            self.log('%s hunger did not drop after the meal. invalidate food cache' % event.message.id)
+            self.food_cache = None
+            return
+        if hunger==0:
+            #clamped. real restore values are unknown
+            return
+        estimates = [self.food_restore(name) for name in meal['items']]
+        scale = drop/sum(estimates)
+        for name,e in dict(zip(meal['items'],estimates)).items():
+            v = self.food_values.get(name)
+            self.food_values[name] = e*scale if v is None else v + (e*scale - v)*FOOD_RESTORE_WEIGHT
+        self.log('%s meal restored %s%%. learned: %s' % (event.message.id,drop,
+            ', '.join(['{} {:.0f}'.format(name,self.food_values[name]) for name in set(meal['items'])])))
+
+    def on_hunger(self, event):
+        """
+        eat from the cached listing when possible, so a meal costs no /myfood round trip.
+        /myfood is asked only if the cache is empty or turned out to be wrong
+        """
+        hungry = self.p().min_hunger_tresh and self.parser.hunger > self.p().min_hunger_tresh
+        if self.food_pending:
+            if hungry:
+                self.log('%s I am hungry. food command is pending already' % event.message.id)
+            return
+        if self.meal:
+            self.learn_meal(event)
+        if not hungry:
+            return
 
-        await event.respond(reply)
-        log('👌%s sent: %s' % (event.message.id,reply))
+        meal = self.plan_meal(self.parser.hunger - self.p().min_hunger_tresh)
+        if meal:
+            self.log('%s I am hungry. eat cached %s' % (event.message.id,', '.join([f['name'] for f in meal])))
+            self.eat(event, meal)
+            return
 
-        if not skip_inactivity_timer:
-            self.reset_inactivity_timer(event)
+        self.log('%s I am hungry. ask for food' % event.message.id)
+        self.food_requested = True
+        self.food_pending += 1
+        self.delayed_reply(event,'/myfood', after_sent = self.on_food_sent)
+
+    def exhausted_poll_delay(self):
+        """ single wake up at the predicted recovery. regular polling if prediction missed or unknown """
+        eta = self.energy.eta(time.time())
+        if eta is None:
+            return EXHAUSTED_MODE_DELAY
+        self.log('energy recovery is expected in %ds (%s)' % (eta,self.energy))
+        eta = int(eta)
+        return (eta, eta + ENERGY_ETA_MARGIN)
+
+    def giant_poll_delay(self):
+        """ poll near the predicted giant defeat. fixed interval until damage rate is known """
+        now = time.time()
+        self.giant.on_reading(now, self.parser.giant_hp, self.parser.giant_max_hp)
+        delay = self.giant.next_poll(now)
+        if delay is None:
+            return GIANT_POLL_INTERVAL
+        self.log('giant: %s. next poll in %ds' % (self.giant,delay))
+        delay = int(delay)
+        return (delay, delay + delay//10)
 
     def on_threshold_matched(self):
         if self.p().threshold_action==Profile.ThresholdAction.gohome:
-            log('threshold action is gohome. change fsm state to GoHome')
+            self.log('threshold action is gohome. change fsm state to GoHome')
             self.state = self.State.GoHome
         elif self.p().threshold_action==Profile.ThresholdAction.stop:
-            log('threshold action is stop. disable events processing')
+            self.log('threshold action is stop. disable events processing')
             self.enabled = False
         else:
-            log('ERROR: unexpected threshold action %s. disable events processing' % self.p().threshold_action)
+            self.log_error('ERROR: unexpected threshold action %s. disable events processing' % self.p().threshold_action)
             self.enabled = False
 
     async def handle_state(self,event):
@@ -674,124 +2525,131 @@ class FSM:
             self.sub_state = 0
         elif self.parser.matched_message==Parser.MatchedMessage.WastelandLocation:
             self.state = self.State.Journey
-            log('%s %s' % (event.message.id,str(self.parser)))
-            if self.parser.hunger and self.p().min_hunger_tresh and int(self.parser.hunger) > self.p().min_hunger_tresh:
-                log('%s I am hungry. ask for food' % event.message.id)
-                self.food_requested = True
-                await self.delayed_reply(event,'/myfood')
+            self.log('%s %s' % (event.message.id,str(self.parser)))
+            if self.parser.hunger is not None:
+                self.on_hunger(event)
         elif self.parser.matched_message==Parser.MatchedMessage.Food:
+            food = [dict(f) for f in self.parser.food]
+            if self.food_cache is not None and food!=self.food_cache:
+                self.log('%s got menu. food cache mismatch, refreshed' % event.message.id)
+            self.food_cache = food
             if self.food_requested:
                 self.food_requested = False
-                found = False
-                for f in self.parser.food:
-                    if self.p().is_food_blacklisted(f['name']):
-                        log('%s got menu. skip blacklisted %s' % (event.message.id,f['name']))
-                        continue
-                    log('%s got menu. eat the first one not blacklisted from the list: %s' % (event.message.id,f['name']))
-                    await self.delayed_reply(event,'/use_%s' % f['id'])
-                    found = True
-                    break
-                # ~ if not found:
+                meal = self.plan_meal(max(1, self.parser.hunger - self.p().min_hunger_tresh) if self.parser.hunger is not None else 1)
+                if meal:
+                    self.log('%s got menu. eat %s' % (event.message.id,', '.join([f['name'] for f in meal])))
+                    self.eat(event, meal)
+                else:
+                    self.log('%s got menu. no allowed food' % event.message.id)
                     # ~ await client.send_message(ctl_chat_id, 'attention required\nno more allowed food')
             else:
-                log('%s got menu. ignore because requested by player manually' % (event.message.id))
+                self.log('%s got menu. ignore because requested by player manually' % (event.message.id))
         elif self.parser.matched_message==Parser.MatchedMessage.Exhausted:
-            log('%s got exhaustion message' % (event.message.id))
+            self.log('%s got exhaustion message' % (event.message.id))
             if self.state != self.State.Exhausted:
                 self.prev_state = self.state
             self.state = self.State.Exhausted
             self.skip_buttons = True
-            await self.delayed_reply(event,'/me',EXHAUSTED_MODE_DELAY, True)
+            self.energy.on_exhausted(time.time())
+            self.delayed_reply(event,'/me',self.exhausted_poll_delay(), True, 'poll')
         elif self.parser.matched_message==Parser.MatchedMessage.Giant:
             if self.state != self.State.Giant:
                 self.prev_state = self.state
             self.state = self.State.Giant
             self.skip_buttons = True
-            await self.delayed_reply(event,'🔎Действие',GIANT_POLL_INTERVAL, True)
+            self.delayed_reply(event,'🔎Действие',GIANT_POLL_INTERVAL, True, 'poll')
         elif self.parser.matched_message==Parser.MatchedMessage.DeepRest:
-            await self.delayed_reply(event,'/deeprest')
+            self.delayed_reply(event,'/deeprest')
 
         #process states
 
         if self.state==self.State.Journey:
             if self.parser.matched_message==Parser.MatchedMessage.GiantBattlefield:
-                if int(self.parser.giant_hp) < 0:
-                    await self.delayed_reply(event,'⚔️Атаковать')
+                if self.parser.giant_hp < 0:
+                    self.delayed_reply(event,'⚔️Атаковать')
                 else:
                     #enter giant poll cycle
                     if self.state != self.State.Giant:
                         self.prev_state = self.state
                     self.state = self.State.Giant
                     self.skip_buttons = True
-                    await self.delayed_reply(event,'🔎Действие',GIANT_POLL_INTERVAL)
+                    self.delayed_reply(event,'🔎Действие',self.giant_poll_delay(), key = 'poll')
             if self.parser.matched_message==Parser.MatchedMessage.WastelandLocation:
-                if self.parser.hp and self.parser.km and int(self.parser.hp) <= self.p().min_hp.get(int(self.parser.km)):
-                    log('%s min hp treshold reached' % event.message.id)
+                if self.parser.hp is not None and self.parser.km is not None and self.parser.hp <= self.p().min_hp.get(self.parser.km):
+                    self.log('%s min hp treshold reached' % event.message.id)
                     self.on_threshold_matched()
                     return
-                if self.parser.km and self.p().max_km_tresh and int(self.parser.km) >= self.p().max_km_tresh:
-                    log('%s max km treshold reached' % event.message.id)
+                if self.parser.km is not None and self.p().max_km_tresh and self.parser.km >= self.p().max_km_tresh:
+                    self.log('%s max km treshold reached' % event.message.id)
+                    self.on_threshold_matched()
+                    return
+                if self.p().daily_budget and self.actions_today() >= self.p().daily_budget:
+                    self.log('%s daily budget of %s actions is spent' % (event.message.id,self.p().daily_budget))
                     self.on_threshold_matched()
                     return
         elif self.state==self.State.Exhausted:
             if self.parser.matched_message==Parser.MatchedMessage.PipBoy:
-                if int(self.parser.energy) > 0:
+                self.energy.on_reading(time.time(), self.parser.energy)
+                if self.parser.energy > 0:
                     #restore previous state. enable buttons processing and request for available actions
                     self.state = self.prev_state
                     self.skip_buttons = False
                     if self.state==self.State.Campus:
-                        await self.delayed_reply(event,'👣Пустошь')
+                        self.delayed_reply(event,'👣Пустошь')
                     else:
-                        await self.delayed_reply(event,'🔎Действие')
+                        self.delayed_reply(event,'🔎Действие')
                 else:
                     #continue energy waiting cycle
-                    await self.delayed_reply(event,'/me',EXHAUSTED_MODE_DELAY)
+                    self.delayed_reply(event,'/me',self.exhausted_poll_delay(), key = 'poll')
         elif self.state==self.State.Giant:
             if self.parser.matched_message==Parser.MatchedMessage.GiantBattlefield:
-                if int(self.parser.giant_hp) < 0:
+                if self.parser.giant_hp < 0:
                     #restore previous state. enable buttons processing and press '⚔️Атаковать' button
                     self.state = self.prev_state
                     self.skip_buttons = False
-                    await self.delayed_reply(event,'⚔️Атаковать')
+                    self.giant.reset()
+                    self.delayed_reply(event,'⚔️Атаковать')
                 else:
                     #continue giant poll cycle
-                    await self.delayed_reply(event,'🔎Действие',GIANT_POLL_INTERVAL)
+                    self.delayed_reply(event,'🔎Действие',self.giant_poll_delay(), key = 'poll')
             else:
-                # ~ log('%s unexpected giant disappearance. change state to the previous one. report to ctl chat' % event.message.id)
+                # ~ self.log('%s unexpected giant disappearance. change state to the previous one. report to ctl chat' % event.message.id)
+                self.giant.reset()
                 self.skip_buttons = False
                 self.state = self.prev_state
                 # ~ await client.send_message(ctl_chat_id, 'attention required\nunexpected giant disappearance')
         elif self.state==self.State.GoHome:
-            if (self.parser.hp and int(self.parser.hp) > self.p().min_hp.get(int(self.parser.km)) and
-                self.parser.km and self.p().max_km_tresh and int(self.parser.km) < self.p().max_km_tresh):
-                log('%s we have more than min hp and less than max km in GoHome state. change state to Journey' % event.message.id)
+            if (self.parser.hp is not None and self.parser.km is not None and
+                self.parser.hp > self.p().min_hp.get(self.parser.km) and
+                self.p().max_km_tresh and self.parser.km < self.p().max_km_tresh):
+                self.log('%s we have more than min hp and less than max km in GoHome state. change state to Journey' % event.message.id)
                 self.state = self.State.Journey
         elif self.state==self.State.Campus:
             if self.sub_state==0:
-                log('{} campus. hp state: {}/{}'.format(event.message.id,self.parser.hp,self.parser.max_hp))
-                if self.parser.hp and self.parser.max_hp and int(self.parser.hp) <  int(self.parser.max_hp) and self.p().autosteam:
+                self.log('{} campus. hp state: {}/{}'.format(event.message.id,self.parser.hp,self.parser.max_hp))
+                if self.parser.hp is not None and self.parser.max_hp and self.parser.hp < self.parser.max_hp and self.p().autosteam:
                     self.sub_state = 1
-                    await self.delayed_reply(event,'💉++ Суперстим')
+                    self.delayed_reply(event,'💉++ Суперстим')
                 else:
                     if self.p().autospeeds:
                         self.sub_state = 2
-                        await self.delayed_reply(event,'💊Speed-ы')
+                        self.delayed_reply(event,'💊Speed-ы')
                     else:
                         self.sub_state = 3
                         if self.p().autoloop:
-                            await self.delayed_reply(event,'👣Пустошь')
+                            self.delayed_reply(event,'👣Пустошь')
             elif self.sub_state==1 and (self.parser.matched_message==Parser.MatchedMessage.SupersteamUsed or self.parser.matched_message==Parser.MatchedMessage.FailedToCraft):
                 if self.p().autospeeds:
                     self.sub_state = 2
-                    await self.delayed_reply(event,'💊Speed-ы')
+                    self.delayed_reply(event,'💊Speed-ы')
                 else:
                     self.sub_state = 3
                     if self.p().autoloop:
-                        await self.delayed_reply(event,'👣Пустошь')
+                        self.delayed_reply(event,'👣Пустошь')
             elif self.sub_state==2 and (self.parser.matched_message==Parser.MatchedMessage.SpeedsUsed or self.parser.matched_message==Parser.MatchedMessage.FailedToCraft):
                 self.sub_state = 3
                 if self.p().autoloop:
-                    await self.delayed_reply(event,'👣Пустошь')
+                    self.delayed_reply(event,'👣Пустошь')
         elif self.state==self.State.Rino:
             if self.sub_state==0:
                 pass
@@ -808,50 +2666,159 @@ class FSM:
 
     def process_buttons(self, event):
         if self.skip_buttons:
-            log('%s buttons processing is disabled' % event.message.id)
+            self.log('%s buttons processing is disabled' % event.message.id)
             return
 
         if not event.message.reply_markup:
-            # ~ log('%s no buttons in reply' % event.message.id)
+            # ~ self.log('%s no buttons in reply' % event.message.id)
             return None
 
+        matched = []
         for row in event.message.reply_markup.rows:
             for button in row.buttons:
-                log("%s '%s'" % (event.message.id,button.text))
-
-        for b in self.buttons:
-            for row in event.message.reply_markup.rows:
-                for button in row.buttons:
-                    # ~ log('%s process button: %s' % (event.message.id,button.text))
-                    if b.match(button.text):
-                        log('%s matched button: %s' % (event.message.id,button.text))
-                        reply = b.process(self, event, button.text)
-                        if(reply):
-                            return reply
+                self.log_debug("%s '%s'", event.message.id, button.text)
+                m = self.buttons_index.get(button.text.translate(self.BUTTON_TEXT_FOLD))
+                if m:
+                    matched.append((m[0],button.text,m[1]))
+
+        for priority,text,b in sorted(matched, key = lambda m: m[0]):
+            self.log('%s matched button: %s' % (event.message.id,text))
+            self.metrics.inc(self.metrics.buttons, b.name)
+            reply = b.process(self, event, text)
+            if(reply):
+                return reply
 
     async def handle_incoming_message(self, event):
+        metrics = self.metrics
+        started = time.perf_counter()
+        metrics.last_event = (event.message.id,started)
 
         self.parser.parse_and_update(event.raw_text)
+        self.request_checkpoint()
+
+        t = time.perf_counter()
+        metrics.observe('parse', t - started)
+        matched = self.parser.matched_message
+        metrics.inc(metrics.messages, matched.name if matched else 'unknown')
+        if self.parser.km is not None and matched==Parser.MatchedMessage.WastelandLocation:
+            metrics.on_km(self.parser.km)
 
         if not self.enabled:
             return None
 
+        state = self.state
         await self.handle_state(event)
+        started, t = t, time.perf_counter()
+        metrics.observe('handle_state', t - started)
+
+        if state in self.POLL_COMMANDS and self.state not in self.POLL_COMMANDS:
+            self.leave_poll_state(event, state)
 
         if not self.enabled:
+            self.count_transition(state)
             return None
 
-        return self.process_buttons(event)
+        reply = self.process_buttons(event)
+        metrics.observe('process_buttons', time.perf_counter() - t)
+        self.count_transition(state)
+        return reply
+
+    def leave_poll_state(self, event, state):
+        """
+        poll states disable buttons and keep keyed poll pending. any way out of them,
+        e.g. location message which switches to Journey directly, has to undo both
+        """
+        if self.scheduler.cancel('poll'):
+            self.log('%s left %s state. pending poll is cancelled' % (event.message.id,state.name))
+        if state==self.State.Giant:
+            self.giant.reset()
+        self.energy.cancel()
+        self.skip_buttons = False
+
+    def count_transition(self, state):
+        if state!=self.state:
+            self.metrics.inc(self.metrics.transitions, '{}->{}'.format(state.name,self.state.name))
+
+    def on_delay(self, event, text):
+        v = text.split()
+        p = self.p()
+        if len(v)==1:
+            return '''delays: {}
+delay km: {}
+daily budget: {}
+actions today: {}
+km/hour: {:.1f}
+'''.format(
+                ','.join(['{}:{:g}-{:g}'.format(c,*p.get_delay(c)) for c in p.DELAY_CATEGORIES]),
+                p.delay_km.to_spec(),
+                p.daily_budget if p.daily_budget else 'unlimited',
+                self.actions_today(),
+                self.metrics.km_per_hour())
+        if len(v)!=3:
+            return 'wrong delay command syntax. check help for available commands'
+        if v[1]=='km':
+            delay_km = p.new_delay_km()
+            ret = delay_km.from_spec(v[2])
+            if ret:
+                return ret
+            p.delay_km = delay_km
+            return 'delay km factors changed to: ' + p.delay_km.to_spec()
+        if v[1]=='budget':
+            try:
+                p.daily_budget = int(v[2])
+            except ValueError:
+                return 'failed to parse input'
+            return 'daily budget is set to: {}'.format(p.daily_budget if p.daily_budget else 'unlimited')
+        ret = p.set_delays('{}:{}'.format(v[1],v[2]))
+        if ret:
+            return ret
+        return 'delay for {} changed to {:g}-{:g} seconds'.format(v[1],*p.get_delay(v[1]))
+
+    def on_stats(self, event, text):
+        watchdog = self.watchdog.remaining() if self.watchdog else None
+        if self.food_cache is None:
+            food = 'unknown'
+        else:
+            food = ', '.join(['{} x{} ~{:.0f}%'.format(f['name'],f['count'],self.food_restore(f['name'])) for f in self.food_cache]) or 'empty'
+        return str(self.metrics) + '\nenergy regeneration: {}\ngiant: {}\ninactivity timer: {}\nfood cache: {}\n'.format(self.energy,self.giant,
+            'in {}s'.format(int(watchdog)) if watchdog is not None else 'off', food)
+
+    async def on_profiling(self, event, text):
+        """ prof/mem [start|stop [N]] """
+        v = text.split()
+        if v[0] not in ('prof','mem'):
+            return 'unknown profiling command. check help for available commands'
+        cpu = v[0]=='prof'
+        if len(v)==1:
+            return '{} profiling: {}'.format('cpu' if cpu else 'memory', profiling.status(profiling.profile_started if cpu else profiling.mem_started))
+        if v[1]=='start':
+            return profiling.start_cpu() if cpu else profiling.start_mem()
+        if v[1]=='stop':
+            try:
+                top = int(v[2]) if len(v) > 2 else PROFILING_TOP
+            except ValueError:
+                return 'wrong number of top entries: ' + v[2]
+            reply = await (profiling.stop_cpu(top) if cpu else profiling.stop_mem(top))
+            return reply[:MAX_CTL_MESSAGE_LEN]
+        return 'unknown profiling command. check help for available commands'
 
     def on_help(self, event, text):
         return '''
 s - show status
+stats - show latencies, counters and km/hour
+prof start/prof stop [N] - cpu profile the whole process. dump is saved to disk, top N functions are shown
+mem start/mem stop [N] - trace memory allocations. snapshot is saved to disk, top N growing lines are shown
 e - switch events processing (%s)
-r - reset. set processing ctl flags and FSM state to the initial values
+r - reset. set processing ctl flags and FSM state to the initial values. drop pending commands
 ? - this help
 v - show version
-update - load bot updates
-restart - restart bot instance
+o - show pending outbound commands
+oc - cancel all pending outbound commands
+log - show log level
+log LEVEL - set log level (debug,info,warning,error)
+update - load bot updates. output is sent as it arrives
+restart - check sources and restart bot instance
+reload - load the new code keeping connection and state
 quit - shutdown bot instance
 
 thresholds:
@@ -879,6 +2846,13 @@ za - enable darkzone autoenter for all known kilometers
 zd - disable darkzone autoenter for all known kilometers
 zX - switch darkzone autoenter for X kilometer
 
+reply delays:
+delay - show delays, daily budget and km/hour
+delay CATEGORY MIN-MAX - set delay range in seconds for replies of category
+  (walk,fight,home,enter,food,campus,default)
+delay km X/Y[,X2/Y2...] - scale delays to X percents from Y kilometer
+delay budget N - daily actions budget. threshold action is applied when spent. 0 - unlimited
+
 dungeons control:
 d - list known dungeons with actual autoenter settings
 da - enable autoenter for all dungeons except of the one on 19km
@@ -1066,38 +3040,38 @@ autojump12,22,31: %s %s %s
         cmd = text[1:]
         if not cmd:
             s = ''
-            for idx in sorted(self.profiles.keys()):
+            for idx in self.profile_indexes():
                 if idx==self.active_profile:
                     s+='*'
-                s+=str(idx) + ': ' + self.profiles[idx].description + '\n'
+                s+=str(idx) + ': ' + self.p(idx).description + '\n'
             return s
 
         try:
             if cmd[0]=='s':
                 cmd = cmd[1:]
                 idx = int(cmd)
-                if idx not in self.profiles:
+                if not self.has_profile(idx):
                     return 'no profile with index: ' + cmd
-                s=str(self.profiles[idx])
+                s=str(self.p(idx))
                 s+='\ndarkzone autoenter:\n'
                 s+=self.get_darkzone_autoenter_status(None,idx)
                 s+='\ndungeons autoenter:\n'
                 s+=self.get_dungeons_autoenter_status(None,idx)
                 s+='\nfood blacklist:\n'
-                s+=self.profiles[idx].get_food_blacklist()
+                s+=self.p(idx).get_food_blacklist()
                 return s
             elif cmd[0]=='l':
                 s = ''
-                for idx in sorted(self.profiles.keys()):
+                for idx in self.profile_indexes():
                     s += '-----BEGIN PROFILE {}-----\n'.format(idx)
                     s+='active: {}\n'.format(idx==self.active_profile)
-                    s+=str(self.profiles[idx])
+                    s+=str(self.p(idx))
                     s+='\ndarkzone autoenter:\n'
                     s+=self.get_darkzone_autoenter_status(None,idx)
                     s+='\ndungeons autoenter:\n'
                     s+=self.get_dungeons_autoenter_status(None,idx)
                     s+='\nfood blacklist:\n'
-                    s+=self.profiles[idx].get_food_blacklist()
+                    s+=self.p(idx).get_food_blacklist()
                     s+= '-----END PROFILE {}-----\n\n'.format(idx)
                 return s
             elif cmd[0]=='c':
@@ -1105,7 +3079,8 @@ autojump12,22,31: %s %s %s
                 idx = int(cmd)
                 if idx==self.active_profile:
                     return 'attempt to overwrite active profile. ignored'
-                self.profiles[idx] = copy.deepcopy(self.profiles[self.active_profile])
+                self.profiles[idx] = copy.deepcopy(self.p())
+                self.profile_changed(idx)
                 return 'active profile was copied {} -> {}'.format(self.active_profile,idx)
             elif cmd[0]=='d':
                 cmd = cmd[1:]
@@ -1113,26 +3088,23 @@ autojump12,22,31: %s %s %s
                 if len(v)!=2:
                     return 'wrong profile description change command syntax'
                 idx = int(v[0])
-                if idx not in self.profiles:
+                if not self.has_profile(idx):
                     return 'no profile with index: ' + cmd
-                self.profiles[idx].description = v[1]
+                self.p(idx).description = v[1]
+                self.profile_changed(idx)
                 return 'description for profile {} changed to: {}'.format(idx,v[1])
             elif cmd[0]=='r':
                 cmd = cmd[1:]
                 idx = int(cmd)
                 if idx==self.active_profile:
                     return 'attempt to remove active profile. ignored'
-                if idx not in self.profiles:
+                if not self.has_profile(idx):
                     return 'no profile with index: ' + cmd
-                del self.profiles[idx]
-                try:
-                    os.remove('{}/{}'.format(PROFILES_DIR,idx))
-                except:
-                    pass
+                self.remove_profile(idx)
                 return 'removed profile with idx' + cmd
             else:
                 idx = int(cmd)
-                if idx not in self.profiles:
+                if not self.has_profile(idx):
                     return 'no profile with index: ' + cmd
                 self.active_profile = idx
                 return 'switched to the profile: ' + str(self.active_profile)
@@ -1150,25 +3122,28 @@ autojump12,22,31: %s %s %s
                 prefix = cmd[2:]
                 if not prefix:
                     return 'wrong food apppend command syntax'
-                self.p().food_blacklist.append(prefix)
+                self.p().food_blacklist += (prefix,)
                 return 'food blacklist appended with prefix: ' + prefix
             elif cmd[0]=='r':
                 idx = int(cmd[1:])
                 if idx < 0 or idx >= len(self.p().food_blacklist):
                     return 'invalid idx: ' + str(idx)
-                del self.p().food_blacklist[idx]
+                l = list(self.p().food_blacklist)
+                del l[idx]
+                self.p().food_blacklist = l
                 return 'removed food blacklist entry by index {}'.format(idx)
             elif cmd[0]=='s':
                 cmd = cmd[1:]
                 v = cmd.split(' ',1)
-                print(v)
                 if len(v)!=2:
                     return 'wrong food set command syntax'
                 idx = int(v[0])
                 prefix = v[1]
                 if idx < 0 or idx >= len(self.p().food_blacklist):
                     return 'invalid idx: ' + str(idx)
-                self.p().food_blacklist[idx] = prefix
+                l = list(self.p().food_blacklist)
+                l[idx] = prefix
+                self.p().food_blacklist = l
                 return 'food blacklist entry by index {} is set to: {}'.format(idx,prefix)
             elif cmd[0]=='c':
                 self.p().food_blacklist = []
@@ -1269,42 +3244,157 @@ autojump12,22,31: %s %s %s
         self.skip_buttons = False
         self.state = self.State.Journey
         self.food_requested = False
+        self.food_pending = 0
+        self.food_cache = None
+        self.meal = None
+        self.energy.cancel()
+        self.scheduler.cancel()
+        self.cancel_inactivity_timer()
         return 'processing control flags and FSM state are set to the initial values'
 
-    def on_version(self,event, text, startup = False):
-        msg = ""
+    @property
+    def runtime_version(self):
+        return runtime_version()
 
-        if not startup:
-            msg += "runtime:  \n" + self.runtime_version + "\n"
-            msg += "fs:\n"
+    def on_version(self,event, text):
+        msg = "runtime:  \n" + self.runtime_version + "\n"
+        msg += "fs:\n"
+        msg += format_version(read_version())
+        return msg
 
-        msg += "  tags: "
-        msg+= subprocess.Popen("git describe --tags", shell=True, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-        msg += "  commit: "
-        msg+= subprocess.Popen("git rev-parse HEAD", shell=True, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
+    def on_outbound(self, event, text):
+        cmd = text[1:]
+        if not cmd:
+            return 'pending commands:\n' + str(self.scheduler)
+        if cmd=='c':
+            #cancelled meal is not going to be sent
+            self.food_pending = 0
+            self.meal = None
+            return 'cancelled {} pending commands'.format(self.scheduler.cancel())
+        return 'unknown outbound control command. check help for available commands'
+
+    def on_log_level(self, event, text):
+        level = text[3:].strip()
+        if not level:
+            return 'log level: %s' % logging.getLevelName(logger.getEffectiveLevel()).lower()
+        if level not in LOG_LEVELS:
+            return 'unknown log level. use one of: ' + ','.join(LOG_LEVELS.keys())
+        logger.setLevel(LOG_LEVELS[level])
+        return 'log level is set to: ' + level
+
+    async def run_command(self, event, title, args, timeout = MAINTENANCE_TIMEOUT):
+        """
+        run external command without blocking events loop. output is sent to the ctl chat
+        in chunks while command runs. returns exit code or None on timeout
+        """
+        self.log('{}: {}'.format(title,' '.join(args)))
+        proc = await asyncio.create_subprocess_exec(*args,
+            stdout = asyncio.subprocess.PIPE,
+            stderr = asyncio.subprocess.STDOUT,
+            cwd = os.path.dirname(os.path.abspath(__file__)),
+            #own process group to kill helpers like ssh on timeout as well
+            start_new_session = True)
+
+        lines = []
+        last_flush = time.monotonic()
+
+        async def flush():
+            nonlocal lines, last_flush
+            last_flush = time.monotonic()
+            if not lines:
+                return
+            out = ''.join(lines)[-MAX_CTL_MESSAGE_LEN:]
+            lines = []
+            self.log('{}:\n{}'.format(title,out))
+            await self.limited_send(event.respond, '{}:\n{}'.format(title,out))
+
+        async def read_output():
+            while True:
+                line = await proc.stdout.readline()
+                if not line:
+                    break
+                lines.append(line.decode('utf-8','replace'))
+                if time.monotonic() - last_flush >= OUTPUT_FLUSH_INTERVAL:
+                    await flush()
+            return await proc.wait()
 
-        return msg
+        try:
+            code = await asyncio.wait_for(read_output(), timeout)
+        except asyncio.TimeoutError:
+            if hasattr(os, 'killpg'):
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+            await proc.wait()
+            code = None
+        await flush()
+        return code
+
+    def start_maintenance(self, event, title, coro):
+        """ run maintenance flow in background, one at a time """
+        if self.maintenance_task and not self.maintenance_task.done():
+            coro.close()
+            return False
+        self.maintenance_task = asyncio.ensure_future(self.maintenance(event, title, coro))
+        return True
+
+    async def maintenance(self, event, title, coro):
+        """ ctl chat was told the flow has started, so it is told about the failure too """
+        try:
+            await coro
+        except Exception as e:
+            self.log_error('%s failed: %s' % (title,e))
+            try:
+                await self.limited_send(event.respond, '{} failed:\n{}: {}'.format(title,type(e).__name__,e))
+            except Exception as e:
+                self.log_error('failed to report %s failure: %s' % (title,e))
+
+    async def update_flow(self, event):
+        code = await self.run_command(event, 'update', ['git','pull'])
+        if code is None:
+            await self.limited_send(event.respond, 'update timed out after {} seconds'.format(MAINTENANCE_TIMEOUT))
+        else:
+            await self.limited_send(event.respond, 'update finished with code {}'.format(code))
+
+    async def restart_flow(self, event):
+        #refuse to restart into the sources which will not even start
+        code = await self.run_command(event, 'check', [sys.executable,'-m','py_compile',os.path.abspath(__file__)])
+        if code!=0:
+            await self.limited_send(event.respond, 'restart cancelled: sources check failed')
+            return
+        os.kill(os.getpid(), signal.SIGHUP)
+
+    async def reload_flow(self, event):
+        try:
+            module = await hot_reload(hosted_accounts)
+        except Exception as e:
+            self.log_error('hot reload failed: %s' % e)
+            await self.limited_send(event.respond, 'reload failed, old code is kept running:\n{}: {}'.format(type(e).__name__,e))
+            return
+        await self.limited_send(event.respond, 'reloaded {} accounts. version:\n{}'.format(len(hosted_accounts),module.runtime_version()))
 
     def on_update(self,event, text):
-        msg = ''
-        out,err = subprocess.Popen("git pull", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        if out:
-            msg+=out.decode("utf-8")
-        if err:
-            msg+=err.decode("utf-8")
-        return msg
+        if not self.start_maintenance(event, 'update', self.update_flow(event)):
+            return 'another update or restart is in progress'
+        return 'update started'
+
+    def on_reload(self,event, text):
+        if not self.start_maintenance(event, 'reload', self.reload_flow(event)):
+            return 'another update or restart is in progress'
 
     def on_restart(self,event, text):
-        if SIGHUP_AVAILABLE:
-            os.kill(os.getpid(), signal.SIGHUP)
-        else:
+        if not SIGHUP_AVAILABLE:
             return "self restart has not available on this platform yet"
+        if not self.start_maintenance(event, 'restart', self.restart_flow(event)):
+            return 'another update or restart is in progress'
+        return 'restart requested. checking sources'
 
     class CtrlCmd:
-        def __init__(self, key, handler, exact_match = True):
+        def __init__(self, key, handler, exact_match = True, changes_profile = False):
             self.key = key
             self.handler = handler
             self.exact_match = exact_match
+            self.changes_profile = changes_profile
 
         def match(self, msg):
             if self.exact_match:
@@ -1316,132 +3406,684 @@ autojump12,22,31: %s %s %s
 
     control_commands = [
         CtrlCmd('s',on_status),
+        CtrlCmd('stats',on_stats),
         CtrlCmd('e',on_events_processing),
-        CtrlCmd('a',on_threshold_action),
-        CtrlCmd('z',on_autodarkzone, False),
+        CtrlCmd('a',on_threshold_action, True, True),
+        CtrlCmd('z',on_autodarkzone, False, True),
+        CtrlCmd('prof',on_profiling, False),
+        CtrlCmd('mem',on_profiling, False),
         CtrlCmd('p',on_profiles, False),
-        CtrlCmd('f',on_food,False),
+        CtrlCmd('f',on_food,False, True),
         CtrlCmd('?',on_help),
         CtrlCmd('quit',on_quit),
         CtrlCmd('update',on_update),
         CtrlCmd('restart',on_restart),
-        CtrlCmd('speed',on_faster),
-        CtrlCmd('steam',on_autosteam),
-        CtrlCmd('l',on_autoloop),
-        CtrlCmd('m',on_autoshoot),
+        CtrlCmd('reload',on_reload),
+        CtrlCmd('speed',on_faster, True, True),
+        CtrlCmd('steam',on_autosteam, True, True),
+        CtrlCmd('l',on_autoloop, True, True),
+        CtrlCmd('m',on_autoshoot, True, True),
         CtrlCmd('r',on_ctl_reset),
         CtrlCmd('v',on_version),
-        CtrlCmd('j12',on_autojump12),
-        CtrlCmd('j22',on_autojump22),
-        CtrlCmd('j31',on_autojump31),
-        CtrlCmd('hp',on_set_min_hp, False),
-        CtrlCmd('c',on_set_cowardice, False),
-        CtrlCmd('h',on_set_min_hunger, False),
-        CtrlCmd('km',on_set_max_km, False),
-        CtrlCmd('d',on_dunge_ctl, False)
+        CtrlCmd('log',on_log_level, False),
+        CtrlCmd('o',on_outbound, False),
+        CtrlCmd('j12',on_autojump12, True, True),
+        CtrlCmd('j22',on_autojump22, True, True),
+        CtrlCmd('j31',on_autojump31, True, True),
+        CtrlCmd('hp',on_set_min_hp, False, True),
+        CtrlCmd('c',on_set_cowardice, False, True),
+        CtrlCmd('h',on_set_min_hunger, False, True),
+        CtrlCmd('km',on_set_max_km, False, True),
+        CtrlCmd('delay',on_delay, False, True),
+        CtrlCmd('d',on_dunge_ctl, False, True)
     ]
 
-    def handle_incoming_control_message(self, event):
+    async def handle_incoming_control_message(self, event):
         for cmd in self.control_commands:
             if cmd.match(event.raw_text):
                 reply = cmd.process(self, event, event.raw_text)
+                if asyncio.iscoroutine(reply):
+                    reply = await reply
+                if cmd.changes_profile:
+                    self.profile_changed()
+                self.request_checkpoint()
                 if reply:
                     return reply
                 return
         return self.on_help(event, event.raw_text)
 
-cfg = configparser.ConfigParser()
-cfg.read('wwalker.cfg')
-
-for s in ['api','bot']:
-    if not s in cfg:
-        raise Exception('missed mandatory section [%s]' % s)
-for opt in ['id','hash']:
-    if opt not in cfg['api']:
-        raise Exception('missed mandatory option "%s" in section [api]' % opt)
-
-fsm = FSM()
+class Journal:
+    """
+    JSON lines log of the game traffic. 'in' records keep incoming messages with keyboards
+    and commands which were pending when the message came, 'out' records keep replies sent by FSM
+    with id of the message they were sent for. 'state' record keeps FSM snapshot taken at start
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, 'a', buffering = 1, encoding = 'utf-8')
+
+    def write(self, record):
+        self.f.write(json.dumps(record, ensure_ascii = False, separators = (',',':')) + '\n')
+
+    def write_state(self, snapshot):
+        self.write({ 't': 'state', 'ts': time.time(), 'state': snapshot })
+
+    def write_incoming(self, event, pending = ()):
+        markup = event.message.reply_markup
+        rows = getattr(markup, 'rows', None)
+        date = getattr(event.message, 'date', None)
+        self.write({
+            't': 'in',
+            'ts': date.timestamp() if date else time.time(),
+            'id': event.message.id,
+            'text': event.raw_text,
+            'rows': [[b.text for b in row.buttons] for row in rows] if rows else None,
+            'pending': [e.text for e in pending]
+        })
+
+    def write_outgoing(self, msg_id, text):
+        self.write({ 't': 'out', 'ts': time.time(), 'id': msg_id, 'text': text })
+
+    def close(self):
+        self.f.close()
+
+    @staticmethod
+    def read(filename):
+        with open(filename, encoding = 'utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+class OfflineEvent:
+    """
+    minimal stand-in for telethon NewMessage event.
+    replies are passed to the respond callback instead of network
+    """
 
-client = TelegramClient('wwalker', cfg['api'].getint('id'), cfg['api']['hash'])
-
-ctl_chat_id = cfg['bot']['ctl_chat_id'] if 'ctl_chat_id' in cfg['bot'] else None
-
-disconnect_task = None
-restart = False
-
-def sighup_handler(signum, frame):
-    global restart
-    restart = True
-    log('got SIGHUP. restart instance')
-    asyncio.ensure_future(client.disconnect())
-
-def terminate_handler(signum, frame):
-    log('terminate instance')
-    asyncio.ensure_future(client.disconnect())
+    class Button:
+        def __init__(self, text):
+            self.text = text
+
+    class Row:
+        def __init__(self, buttons):
+            self.buttons = [OfflineEvent.Button(text) for text in buttons]
+
+    class Markup:
+        def __init__(self, rows):
+            self.rows = [OfflineEvent.Row(row) for row in rows]
+
+    class Message:
+        def __init__(self, msg_id, date, reply_markup, to_id = None):
+            self.id = msg_id
+            self.date = date
+            self.reply_markup = reply_markup
+            self.to_id = to_id
+
+    def __init__(self, msg_id, text, rows = None, ts = None, respond = None, to_id = None):
+        self.raw_text = text
+        date = datetime.datetime.fromtimestamp(ts if ts is not None else time.time(), datetime.timezone.utc)
+        self.message = self.Message(msg_id, date, self.Markup(rows) if rows else None, to_id)
+        self.on_respond = respond
+
+    async def respond(self, text):
+        if self.on_respond:
+            await self.on_respond(self, text)
+
+async def replay_journal(filename, profiles_dir = None):
+    """
+    feed recorded incoming messages through the FSM seeded with the recorded state.
+    before every message the commands sent live by then are sent, the ones pending live stay queued.
+    returns (events,elapsed seconds,list of changed decisions)
+    """
+    fsm = FSM('replay', profiles_dir)
+    fsm.scheduler.manual = True
+
+    records = list(Journal.read(filename))
+    incoming = [r for r in records if r['t']=='in']
+    recorded = dict()
+    for r in records:
+        if r['t']=='out':
+            recorded.setdefault(r['id'],[]).append(r['text'])
+
+    replayed = dict()
+
+    async def respond(event, text):
+        replayed.setdefault(event.message.id,[]).append(text)
+
+    async def send(text):
+        replayed.setdefault(None,[]).append(text)
+
+    started = time.perf_counter()
+    for r in records:
+        if r['t']=='state':
+            #new instance started here. commands of the previous one are lost
+            fsm.scheduler.cancel()
+            fsm.food_pending = 0
+            fsm.apply_snapshot(r['state'])
+            fsm.resume_pending(r['state']['pending'], send)
+        elif r['t']=='in':
+            await fsm.scheduler.flush(r.get('pending', ()))
+            event = OfflineEvent(r['id'], r['text'], r['rows'], r['ts'], respond)
+            reply = await fsm.handle_incoming_message(event)
+            if reply:
+                fsm.delayed_reply(event, reply)
+    #commands still pending at the end of the journal were not sent live either
+    elapsed = time.perf_counter() - started
+
+    fsm.cancel_inactivity_timer()
+
+    changed = []
+    for r in incoming:
+        was = recorded.get(r['id'],[])
+        now = replayed.get(r['id'],[])
+        if was!=now:
+            changed.append((r['id'],was,now))
+
+    return (len(incoming), elapsed, changed)
+
+def replay_main(filename, profiles_dir):
+    #per event logging would dominate the measurements
+    logger.setLevel(logging.WARNING)
+
+    (events, elapsed, changed) = asyncio.get_event_loop().run_until_complete(replay_journal(filename, profiles_dir))
+
+    print('replayed {} events in {:.3f}s: {:.0f} events/sec'.format(events, elapsed, events/elapsed if elapsed else 0))
+    print('changed decisions: {}'.format(len(changed)))
+    for msg_id, was, now in changed:
+        print('  {}: {} -> {}'.format(msg_id, was, now))
+
+    return 1 if changed else 0
+
+GAME_BOT = 'WastelandWarsBot'
+
+ACCOUNT_SECTION_PREFIX = 'account '
+
+class Account:
+    """
+    telegram session with its own FSM. any number of accounts may share one events loop
+    """
+
+    def __init__(self, name, api_id, api_hash, session, ctl_chat_id = None, profiles_dir = PROFILES_DIR, journal = None, client = None, store = None, checkpoint = None, limiter = None):
+        self.name = name
+        self.ctl_chat_id = ctl_chat_id
+        self.ctl_chat = None
+        self.fsm = FSM(name, profiles_dir, store)
+        if journal:
+            self.fsm.journal = Journal(journal)
+        self.fsm.checkpoint_file = checkpoint
+        self.fsm.limiter = limiter
+        #client may be substituted with the local stand-in (see loadtest.py)
+        self.client = client if client else TelegramClient(session, api_id, api_hash)
+
+        self.counters = { 'events': 0, 'replies': 0, 'errors': 0 }
+        #registered (callback,event) pairs. kept to unregister them on hot reload
+        self.handlers = []
+
+    def log(self, msg):
+        self.fsm.log(msg)
+
+    def register_handlers(self):
+        if self.ctl_chat:
+            self.handlers = [
+                (self.ctl_handler, events.NewMessage(outgoing=True, chats=[self.ctl_chat])),
+                (self.handler, events.NewMessage(incoming=True, chats=[GAME_BOT]))
+            ]
+        else:
+            self.handlers = [(self.any_handler, events.NewMessage(outgoing=True))]
+        for callback,event in self.handlers:
+            self.client.add_event_handler(callback, event)
+
+    def unregister_handlers(self):
+        for callback,event in self.handlers:
+            self.client.remove_event_handler(callback, event)
+        self.handlers = []
+
+    async def start(self, interactive = True):
+        if interactive:
+            await self.client.start()
+        else:
+            #supervised workers have no terminal to ask for phone and code
+            await self.client.connect()
+            if not await self.client.is_user_authorized():
+                raise Exception('account %s is not authorized. run it once without supervisor to log in' % self.name)
+
+        #before any handler is registered, so no event is applied to the state being replaced
+        self.fsm.restore_checkpoint(self.send_to_game)
+        if self.fsm.journal:
+            self.fsm.journal.write_state(self.fsm.snapshot())
+
+        if self.ctl_chat_id:
+            self.ctl_chat = await self.client.get_entity(PeerChat(int(self.ctl_chat_id)))
+            self.register_handlers()
+
+            hi_msg = 'started new instance %s with version:\n%s' % (os.getpid(),self.fsm.runtime_version)
+            self.log(hi_msg)
+            await self.send_to_ctl(hi_msg)
+        else:
+            self.log('ctl_chat_id is not set.\ntype /id in the control chat to get appropriate configuration changes')
+            self.register_handlers()
 
-if SIGHUP_AVAILABLE:
-    signal.signal(signal.SIGHUP, sighup_handler)
+    async def send_to_game(self, text):
+        await self.client.send_message(GAME_BOT, text)
 
-signal.signal(signal.SIGINT, terminate_handler)
-signal.signal(signal.SIGTERM, terminate_handler)
+    async def send_to_ctl(self, text):
+        await self.fsm.limited_send(lambda text: self.client.send_message(self.ctl_chat, text), text)
 
-client.start()
+    def disconnect(self):
+        asyncio.ensure_future(self.client.disconnect())
 
-if ctl_chat_id:
-    ctl_chat = client.get_entity(PeerChat(int(ctl_chat_id)))
+    def health(self):
+        h = dict(self.counters)
+        h['connected'] = self.client.is_connected()
+        h['state'] = self.fsm.state.name
+        h['enabled'] = self.fsm.enabled
+        return h
 
-    @client.on(events.NewMessage(outgoing=True, chats=[ctl_chat]))
-    async def ctl_handler(event):
-        log('👀%s got ctl request: %s' % (event.message.id, event.raw_text))
+    async def ctl_handler(self, event):
+        self.log('👀%s got ctl request: %s' % (event.message.id, event.raw_text))
+        reply = None
         try:
-            reply = fsm.handle_incoming_control_message(event)
+            reply = await self.fsm.handle_incoming_control_message(event)
         except Exception as e:
             exc_type, exc_obj, exc_tb = sys.exc_info()
             fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-            log('🖕%s exception %s\n%s %s:%s' % (event.message.id,e,exc_type,fname,exc_tb.tb_lineno))
-            await client.send_message(ctl_chat_id, '🖕%s exception %s\n%s %s:%s' % (event.message.id,e,exc_type,fname,exc_tb.tb_lineno))
+            self.fsm.log_error('🖕%s exception %s\n%s %s:%s' % (event.message.id,e,exc_type,fname,exc_tb.tb_lineno))
+            await self.send_to_ctl('🖕%s exception %s\n%s %s:%s' % (event.message.id,e,exc_type,fname,exc_tb.tb_lineno))
 
         if(reply):
-            await event.respond(reply)
+            await self.fsm.limited_send(event.respond, reply)
+
+    async def handler(self, event):
+        self.log('👀%s got update from WW' % event.message.id)
+        self.counters['events'] += 1
+
+        if self.fsm.journal:
+            self.fsm.journal.write_incoming(event, self.fsm.scheduler.pending())
 
-    @client.on(events.NewMessage(incoming=True, chats=['WastelandWarsBot']))
-    async def handler(event):
-        log('👀%s got update from WW' % event.message.id)
-    
+        reply = None
         try:
-            reply = await fsm.handle_incoming_message(event)
+            reply = await self.fsm.handle_incoming_message(event)
         except Exception as e:
+            self.counters['errors'] += 1
             exc_type, exc_obj, exc_tb = sys.exc_info()
             fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-            log('🖕%s exception %s\n%s %s:%s' % (event.message.id,e,exc_type,fname,exc_tb.tb_lineno))
-            # ~ await client.send_message(ctl_chat_id, '🖕%s exception %s\n%s %s:%s' % (event.message.id,e,exc_type,fname,exc_tb.tb_lineno))
+            self.fsm.log_error('🖕%s exception %s\n%s %s:%s' % (event.message.id,e,exc_type,fname,exc_tb.tb_lineno))
+            # ~ await self.client.send_message(self.ctl_chat, '🖕%s exception %s\n%s %s:%s' % (event.message.id,e,exc_type,fname,exc_tb.tb_lineno))
 
         if reply:
-            await fsm.delayed_reply(event,reply)
+            self.counters['replies'] += 1
+            self.fsm.delayed_reply(event,reply)
         # ~ else:
-            # ~ log('💤%s no reply generated by fsm' % event.message.id)
-
-    hi_msg = 'started new instance %s with version:\n%s' % (os.getpid(),fsm.runtime_version)
-    log(hi_msg)
-    client.send_message(ctl_chat, hi_msg)
+            # ~ self.log('💤%s no reply generated by fsm' % event.message.id)
 
-    print('use ? in ctl chat for help')
-
-else:
-    print('ctl_chat_id is not set.\ntype /id in the control chat to get appropriate configuration changes')
-    @client.on(events.NewMessage(outgoing=True))
-    async def any_handler(event):
+    async def any_handler(self, event):
         if '/id'==event.raw_text:
             if isinstance(event.message.to_id,PeerChat):
-                print('add this option to the [bot] section and restart script:\nctl_chat_id = {}'.format(event.message.to_id.chat_id))
+                section = '[bot]' if self.name is None else '[%s%s]' % (ACCOUNT_SECTION_PREFIX,self.name)
+                self.log('add this option to the {} section and restart script:\nctl_chat_id = {}'.format(section,event.message.to_id.chat_id))
+
+#accounts served by this process. hot reload moves them to the new code
+hosted_accounts = []
+reload_generation = 0
+
+def load_module_copy():
+    """ fresh instance of this module from the sources on disk """
+    global reload_generation
+    reload_generation += 1
+    name = 'wwalker_reload_%d' % reload_generation
+    spec = importlib.util.spec_from_file_location(name, os.path.abspath(__file__))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules.pop('wwalker_reload_%d' % (reload_generation - 1), None)
+    sys.modules[name] = module
+    return module
+
+async def hot_reload(accounts):
+    """
+    re-import decision logic and move live accounts to it.
+    telegram clients stay connected, only event handlers are re-registered.
+    returns the new module. old code keeps running if import fails
+    """
+    module = await asyncio.get_event_loop().run_in_executor(None, load_module_copy)
+    module.reload_generation = reload_generation
+    module.hosted_accounts = accounts
+    #running profiling windows are process wide
+    module.profiling = profiling
+    module.global_limiter = global_limiter
+    module.timer_wheels = timer_wheels
+    #single writer keeps the order of profile and checkpoint writes queued before reload
+    module.disk_writer.shutdown(wait = False)
+    module.disk_writer = disk_writer
+
+    for a in accounts:
+        a.unregister_handlers()
+        a.__class__ = module.Account
+        a.fsm.__class__ = module.FSM
+        a.fsm.on_reloaded()
+        a.register_handlers()
+        a.log('hot reload done. generation %d' % reload_generation)
+    return module
+
+def account_names(cfg):
+    return [s[len(ACCOUNT_SECTION_PREFIX):].strip() for s in cfg.sections() if s.startswith(ACCOUNT_SECTION_PREFIX)]
+
+def load_accounts(cfg, shard = None):
+    """
+    [bot] section describes the single account setup.
+    every [account NAME] section adds one more account hosted by the same process.
+    shard (idx,count) selects every count-th account starting from idx
+    """
+    if not 'api' in cfg:
+        raise Exception('missed mandatory section [api]')
+    for opt in ['id','hash']:
+        if opt not in cfg['api']:
+            raise Exception('missed mandatory option "%s" in section [api]' % opt)
+
+    api_id = cfg['api'].getint('id')
+    api_hash = cfg['api']['hash']
+
+    store = open_profiles_store(cfg)
+    limiter = setup_limits(cfg)
+
+    names = account_names(cfg)
+    if not names:
+        if not 'bot' in cfg:
+            raise Exception('missed mandatory section [bot]')
+        bot = cfg['bot']
+        return [Account(None, api_id, api_hash, 'wwalker', bot.get('ctl_chat_id'), PROFILES_DIR, bot.get('journal'),
+            store = store, checkpoint = bot.get('checkpoint', 'wwalker' + CHECKPOINT_SUFFIX), limiter = limiter())]
+
+    if shard:
+        names = names[shard[0]::shard[1]]
+
+    accounts = []
+    for name in names:
+        section = cfg[ACCOUNT_SECTION_PREFIX + name]
+        accounts.append(Account(name,
+            section.getint('api_id', api_id),
+            section.get('api_hash', api_hash),
+            section.get('session', name),
+            section.get('ctl_chat_id'),
+            section.get('profiles_dir', PROFILES_DIR + '_' + name),
+            section.get('journal'),
+            store = store,
+            checkpoint = section.get('checkpoint', section.get('session', name) + CHECKPOINT_SUFFIX),
+            limiter = limiter()))
+    return accounts
+
+def read_config():
+    cfg = configparser.ConfigParser()
+    cfg.read(CONFIG_FILE)
+    return cfg
+
+def run_accounts(accounts, interactive = True, status_queue = None, worker_idx = None, metrics = None):
+    """
+    serve accounts until disconnect. returns True if restart was requested
+    """
+    restart = False
+    hosted_accounts[:] = accounts
+
+    loop = asyncio.get_event_loop()
+
+    #signal handlers are called between loop iterations. wake up the loop explicitly
+    def disconnect_all():
+        for a in accounts:
+            loop.call_soon_threadsafe(a.disconnect)
+
+    def sighup_handler(signum, frame):
+        nonlocal restart
+        restart = True
+        log('got SIGHUP. restart instance')
+        disconnect_all()
+
+    def terminate_handler(signum, frame):
+        log('terminate instance')
+        disconnect_all()
+
+    if SIGHUP_AVAILABLE:
+        signal.signal(signal.SIGHUP, sighup_handler)
+
+    signal.signal(signal.SIGINT, terminate_handler)
+    signal.signal(signal.SIGTERM, terminate_handler)
+
+    async def heartbeat():
+        while True:
+            status_queue.put({
+                'worker': worker_idx,
+                'pid': os.getpid(),
+                'time': time.time(),
+                'accounts': { str(a.name): a.health() for a in accounts }
+            })
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    #startup of many accounts may take longer than HEARTBEAT_TIMEOUT
+    if status_queue is not None:
+        asyncio.ensure_future(heartbeat())
+
+    if interactive:
+        #start accounts one by one to not mix up interactive authorization prompts
+        for a in accounts:
+            loop.run_until_complete(a.start(interactive))
+    else:
+        loop.run_until_complete(asyncio.gather(*[a.start(interactive) for a in accounts]))
+
+    log('{} accounts started. use ? in ctl chat for help'.format(len(accounts)))
+
+    if metrics is not None:
+        loop.run_until_complete(start_metrics_export(metrics, accounts, worker_idx))
+
+    log('entering events processing cycle. use Ctrl+C to terminate or ctl chat')
+    loop.run_until_complete(asyncio.gather(*[a.client.run_until_disconnected() for a in accounts]))
+
+    for a in accounts:
+        a.fsm.save_profiles()
+        a.fsm.save_checkpoint()
+    #checkpoints and metrics may still be queued. restart execs right after return
+    wait_disk_writes()
+
+    return restart
+
+def worker_main(worker_idx, workers, status_queue):
+    cfg = read_config()
+    setup_logging(cfg, 'worker%s' % worker_idx)
+
+    accounts = load_accounts(cfg, (worker_idx, workers))
+    restart = run_accounts(accounts, False, status_queue, worker_idx, cfg['metrics'] if 'metrics' in cfg else None)
+
+    log('worker %s exits%s' % (worker_idx, '. restart requested' if restart else ''))
+    shutdown_logging()
+    sys.exit(RESTART_EXIT_CODE if restart else 0)
+
+class Supervisor:
+    """
+    spreads accounts over the pool of worker processes,
+    restarts crashed, hung or self restarting workers and rolls up their health
+    """
+
+    class Worker:
+        def __init__(self, idx):
+            self.idx = idx
+            self.process = None
+            self.restarts = 0
+            self.backoff = 0
+            self.restart_at = None
+            self.started = None
+            self.heartbeat = None
+            self.accounts = dict()
+            self.finished = False
+
+    def __init__(self, cfg, workers):
+        self.cfg = cfg
+        accounts = account_names(cfg)
+        if not accounts:
+            raise Exception('supervisor requires [account NAME] sections in config')
+        if not workers:
+            workers = os.cpu_count() or 1
+        self.count = min(workers, len(accounts))
+        self.ctx = multiprocessing.get_context('spawn')
+        self.status_queue = self.ctx.Queue()
+        self.workers = [self.Worker(i) for i in range(self.count)]
+        self.stopping = False
+        self.status_file = cfg['supervisor'].get('status_file') if 'supervisor' in cfg else None
+
+    def spawn(self, w):
+        w.process = self.ctx.Process(target = worker_main, args = (w.idx, self.count, self.status_queue), name = 'wwalker-worker%s' % w.idx)
+        w.process.start()
+        w.started = w.heartbeat = time.time()
+        w.restart_at = None
+        log('worker %s started with pid %s' % (w.idx, w.process.pid))
+
+    def on_exit(self, w):
+        code = w.process.exitcode
+        w.process = None
+        if self.stopping:
+            return
+        if code==0:
+            log('worker %s finished' % w.idx)
+            w.finished = True
+            return
+        w.restarts += 1
+        if code==RESTART_EXIT_CODE:
+            log('worker %s requested restart' % w.idx)
+            w.backoff = 0
+        else:
+            w.backoff = min(max(w.backoff*2, RESTART_BACKOFF[0]), RESTART_BACKOFF[1])
+            log_error('worker %s crashed with exit code %s. restart in %s seconds' % (w.idx, code, w.backoff))
+        w.restart_at = time.time() + w.backoff
+
+    def process_status(self, status):
+        w = self.workers[status['worker']]
+        w.heartbeat = status['time']
+        w.accounts = status['accounts']
+        #worker survived long enough, forget about previous crashes
+        if w.heartbeat - w.started > HEARTBEAT_TIMEOUT:
+            w.backoff = 0
+
+    def rollup(self):
+        now = time.time()
+        totals = { 'events': 0, 'replies': 0, 'errors': 0 }
+        workers = []
+        for w in self.workers:
+            alive = w.process is not None and w.process.is_alive()
+            for h in w.accounts.values():
+                for k in totals.keys():
+                    totals[k] += h.get(k,0)
+            workers.append({
+                'worker': w.idx,
+                'pid': w.process.pid if alive else None,
+                'alive': alive,
+                'restarts': w.restarts,
+                'heartbeat_age': int(now - w.heartbeat) if w.heartbeat else None,
+                'accounts': w.accounts
+            })
+        return { 'time': now, 'totals': totals, 'workers': workers }
+
+    def report(self):
+        r = self.rollup()
+        s = 'fleet: events {events}, replies {replies}, errors {errors}\n'.format(**r['totals'])
+        for w in r['workers']:
+            s += 'worker {}: pid {} alive {} restarts {} heartbeat {}s ago accounts {}\n'.format(
+                w['worker'], w['pid'], w['alive'], w['restarts'], w['heartbeat_age'], len(w['accounts']))
+        log(s)
+        if self.status_file:
+            with open(self.status_file, 'w') as f:
+                json.dump(r, f, indent = 1)
+
+    def run(self):
+
+        def terminate_handler(signum, frame):
+            log('terminate supervisor')
+            self.stopping = True
+
+        def sighup_handler(signum, frame):
+            log('got SIGHUP. restart all workers')
+            for w in self.workers:
+                if w.process and w.process.is_alive():
+                    os.kill(w.process.pid, signal.SIGHUP)
+
+        if SIGHUP_AVAILABLE:
+            signal.signal(signal.SIGHUP, sighup_handler)
+        signal.signal(signal.SIGINT, terminate_handler)
+        signal.signal(signal.SIGTERM, terminate_handler)
+
+        log('supervisor %s spreads accounts over %s workers' % (os.getpid(), self.count))
+        for w in self.workers:
+            self.spawn(w)
+
+        last_rollup = time.time()
+        while not self.stopping:
+            try:
+                self.process_status(self.status_queue.get(timeout = 1))
+            except queue.Empty:
+                pass
+
+            if self.stopping:
+                break
+
+            now = time.time()
+            for w in self.workers:
+                if w.process is not None:
+                    if not w.process.is_alive():
+                        w.process.join()
+                        self.on_exit(w)
+                    elif now - w.heartbeat > HEARTBEAT_TIMEOUT:
+                        log_error('worker %s does not respond for %s seconds. kill it' % (w.idx, int(now - w.heartbeat)))
+                        w.process.kill()
+                elif w.restart_at is not None and now >= w.restart_at:
+                    self.spawn(w)
+
+            if all(w.finished for w in self.workers):
+                log('all workers finished')
+                break
+
+            if now - last_rollup >= ROLLUP_INTERVAL:
+                last_rollup = now
+                self.report()
+
+        for w in self.workers:
+            if w.process and w.process.is_alive():
+                w.process.terminate()
+        for w in self.workers:
+            if w.process:
+                w.process.join()
+        self.report()
+
+def main():
+    arg_parser = argparse.ArgumentParser(description = 'WastelandWarsBot walker')
+    arg_parser.add_argument('--workers', type = int, metavar = 'N',
+        help = 'run supervisor which spreads [account NAME] sections over N worker processes (0 - one per CPU core)')
+    arg_parser.add_argument('--replay', metavar = 'JOURNAL',
+        help = 'feed recorded journal through the fresh FSM without delays and report changed decisions')
+    arg_parser.add_argument('--replay-profiles', metavar = 'DIR',
+        help = 'profiles directory for --replay. default profile is used if omitted')
+    args = arg_parser.parse_args()
+
+    cfg = read_config()
+
+    setup_logging(cfg)
+
+    if args.replay:
+        code = replay_main(args.replay, args.replay_profiles)
+        shutdown_logging()
+        sys.exit(code)
+
+    if args.workers is not None:
+        Supervisor(cfg, args.workers).run()
+        log('bye')
+        shutdown_logging()
+        return
 
-print('entering events processing cycle. use Ctrl+C to terminate or ctl chat')
-client.run_until_disconnected()
+    accounts = load_accounts(cfg)
 
-fsm.save_profiles()
+    if run_accounts(accounts, metrics = cfg['metrics'] if 'metrics' in cfg else None):
+        log('replace instance %s' % os.getpid())
+        shutdown_logging()
+        os.execl('/usr/bin/python3','-c',__file__)
+    else:
+        log('bye')
+        shutdown_logging()
 
-if restart:
-    log('replace instance %s' % os.getpid())
-    os.execl('/usr/bin/python3','-c',__file__)
-else:
-    log('bye')
+if __name__ == '__main__':
+    main()